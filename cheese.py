@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+import copy
+import numpy as np
+from phidl import Device
+import phidl.geometry as pg
+from .polystore import PolygonStore, _origins
+from .spatial import _Grid, _bucket, _segments
+
+def _unique_cells(D):
+    # All cells in the hierarchy of D, each once
+    cells, todo = {}, [D]
+    while todo:
+        cell = todo.pop()
+        if cell.uid not in cells:
+            cells[cell.uid] = cell
+            todo += [ref.parent for ref in cell.references]
+    return list(cells.values())
+
+def _copy(D):
+    # Deep copy of the hierarchy of D. Every cell gets a new uid, so that the copies are not mistaken for the
+    # originals by anything that caches cells by uid.
+    C = copy.deepcopy(D)
+    for cell in _unique_cells(C):
+        cell.uid = Device._next_uid
+        Device._next_uid += 1
+        cell._bb_valid = False
+    return C
+
+def _local(p, ref):
+    # Points or vectors p (..., 2) relative to the origin of ref, in the coordinates of the referenced cell
+    ca, sa = np.cos(np.radians(ref.rotation or 0)), np.sin(np.radians(ref.rotation or 0))
+    m = ref.magnification or 1
+    x, y = (p[..., 0]*ca + p[..., 1]*sa) / m, (p[..., 1]*ca - p[..., 0]*sa) / m
+    return np.stack([x, -y if ref.x_reflection else y], axis=-1)
+
+def _port_segments(D, reach):
+    # Port segments of every cell and of all cells above it, as (starts, directions) in the cell's own
+    # coordinates. Cells are visited after all cells referencing them. Ports of a parent are mapped through
+    # every instance of the reference, and only those within reach of the child's bounding box are kept.
+    order, seen = [], set()
+    def visit(cell):
+        seen.add(cell.uid)
+        for ref in cell.references:
+            if ref.parent.uid not in seen:
+                visit(ref.parent)
+        order.append(cell)
+    visit(D)
+    segments = {cell.uid: [] for cell in order}
+    for cell in reversed(order):
+        ports = list(cell.ports.values())
+        t = np.radians([port.orientation for port in ports])
+        u = np.stack([-np.sin(t), np.cos(t)], axis=1) * np.array([port.width for port in ports])[:, None] / 2
+        mid = np.array([port.midpoint for port in ports], dtype=float).reshape(-1, 2)
+        a = np.concatenate([mid - u] + [a for a, _ in segments[cell.uid]])
+        d = np.concatenate([2 * u] + [d for _, d in segments[cell.uid]])
+        segments[cell.uid] = (a, d)
+        if len(a) == 0:
+            continue
+        for ref in cell.references:
+            child = ref.parent
+            # Holes of an earlier cheese don't get holes themselves
+            if 'cheese' in child.info:
+                continue
+            origins = _origins(ref)
+            starts = _local(a[None, :, :] - origins[:, None, :], ref).reshape(-1, 2)
+            directions = np.tile(_local(d, ref), (len(origins), 1))
+            box = child.bbox
+            lo, hi = np.minimum(starts, starts + directions), np.maximum(starts, starts + directions)
+            near = np.all((lo <= box[1] + reach) & (hi >= box[0] - reach), axis=1)
+            segments[child.uid].append((starts[near], directions[near]))
+    return segments
+
+def _inside(polygon, xs, ys):
+    # Mask (len(ys), len(xs)) of the lattice points inside polygon. Every edge crossing a lattice row flips
+    # the points to its right, so the parity of the cumulative crossings along the row is the mask.
+    a, b = polygon, np.roll(polygon, -1, axis=0)
+    r0 = np.searchsorted(ys, np.minimum(a[:, 1], b[:, 1]), 'left')
+    r1 = np.searchsorted(ys, np.maximum(a[:, 1], b[:, 1]), 'left')
+    n = r1 - r0
+    edge = np.repeat(np.arange(len(a)), n)
+    row = np.repeat(r0 - np.cumsum(n) + n, n) + np.arange(len(edge))
+    y = ys[row]
+    x = a[edge, 0] + (y - a[edge, 1]) * (b[edge, 0] - a[edge, 0]) / (b[edge, 1] - a[edge, 1])
+    flips = np.zeros((len(ys), len(xs) + 1), dtype=np.int64)
+    np.add.at(flips, (row, np.searchsorted(xs, x, 'left')), 1)
+    return np.cumsum(flips, axis=1)[:, :-1] % 2 == 1
+
+def _crossed(boxes, a, b):
+    # Whether the segments from a to b pass through the boxes (n, 4), by clipping them against both slabs
+    t0, t1 = np.zeros(len(a)), np.ones(len(a))
+    d = b - a
+    for k in (0, 1):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ta, tb = (boxes[:, k] - a[:, k]) / d[:, k], (boxes[:, k + 2] - a[:, k]) / d[:, k]
+        within = (a[:, k] >= boxes[:, k]) & (a[:, k] <= boxes[:, k + 2])
+        parallel = d[:, k] == 0
+        lo = np.where(parallel, np.where(within, -np.inf, np.inf), np.minimum(ta, tb))
+        hi = np.where(parallel, np.where(within, np.inf, -np.inf), np.maximum(ta, tb))
+        t0, t1 = np.maximum(t0, lo), np.minimum(t1, hi)
+    return t0 <= t1
+
+def _blocks(mask):
+    # Splits a boolean mask into rectangles (row, col, rows, cols). Runs of True along the rows are stacked
+    # with identical runs in the rows right above them.
+    padded = np.pad(mask, ((0, 0), (1, 1))).astype(np.int8)
+    row, start = np.nonzero(np.diff(padded, axis=1) == 1)
+    end = np.nonzero(np.diff(padded, axis=1) == -1)[1]
+    if len(row) == 0:
+        return np.zeros((0, 4), dtype=np.int64)
+    order = np.lexsort((row, end, start))
+    row, start, end = row[order], start[order], end[order]
+    new = np.r_[True, (start[1:] != start[:-1]) | (end[1:] != end[:-1]) | (row[1:] != row[:-1] + 1)]
+    block = np.cumsum(new) - 1
+    first = np.flatnonzero(new)
+    return np.stack([row[first], start[first], np.bincount(block), end[first] - start[first]], axis=1)
+
+def _lattice(lo, hi, pitch):
+    # Lattice coordinates in [lo, hi], centered between them
+    n = int(np.floor((hi - lo) / pitch + 1e-9)) + 1 if hi >= lo else 0
+    return (lo + hi) / 2 + (np.arange(n) - (n - 1) / 2) * pitch
+
+def _holes(polygon, hole_size, pitch, margin, ports, port_keepout):
+    # Mask and lattice of the holes that fit into polygon with margin to its edges and away from the port
+    # segments, given as (starts, directions)
+    reach = np.asarray(hole_size) / 2 + margin
+    lo, hi = polygon.min(axis=0) + reach, polygon.max(axis=0) - reach
+    xs, ys = _lattice(lo[0], hi[0], pitch[0]), _lattice(lo[1], hi[1], pitch[1])
+    if len(xs) == 0 or len(ys) == 0:
+        return np.zeros((len(ys), len(xs)), dtype=bool), xs, ys
+    mask = _inside(polygon, xs, ys)
+    j, i = np.nonzero(mask)
+    centers = np.stack([xs[i], ys[j]], axis=1)
+
+    # Holes inside the polygon are still out if one of its edges passes through them or their margin
+    a, b = polygon, np.roll(polygon, -1, axis=0)
+    grid = _Grid(_bucket(np.c_[np.minimum(a, b), np.maximum(a, b)]))
+    grid.extend(np.c_[np.minimum(a, b), np.maximum(a, b)], np.arange(len(a)))
+    boxes = np.c_[centers - reach, centers + reach]
+    k, e = grid.pairs(boxes)
+    bad = np.zeros(len(centers), dtype=bool)
+    bad[k[_crossed(boxes[k], a[e], b[e])]] = True
+
+    # Ports keep holes at port_keepout from their edge
+    radius = np.hypot(*hole_size) / 2 + port_keepout
+    for start, direction in zip(*ports):
+        bad |= _segments(centers, start[None, :], direction[None, :]) < radius
+    mask[j[bad], i[bad]] = False
+    return mask, xs, ys
+
+# Cheeses large polygons of a layer with a lattice of rectangular holes, to trap vortices in wide
+# superconducting areas such as pads and ground planes
+#   D --> Device to cheese, it is not changed
+#   layer --> layer of the metal, int for all datatypes or (layer, datatype)
+#   hole_layer --> layer of the holes
+#   hole_size --> (width, height) of a hole
+#   pitch --> (x, y) distance between holes
+#   margin --> smallest distance between a hole and the edge of its polygon
+#   min_size --> polygons narrower than this in x or y are left alone
+#   port_keepout --> smallest distance between a hole and the ports of the cell the polygon is in and of
+#                    all cells above it
+#
+# The hierarchy of D is copied and every unique cell of the copy is cheesed once, so all references to
+# a pad share its holes while the cells of D, which may be used elsewhere, are left alone. A cell used in
+# several places keeps its holes away from the ports around all of them. The holes of each polygon are
+# found with point-in-polygon masks over its lattice and put down as array references to a single hole
+# cell, one array per rectangular block of holes. Cells already cheesed on layer are skipped, so
+# cheesing a cheesed Device again changes nothing.
+# Returns the cheesed copy of D.
+def cheese(D, layer, hole_layer, hole_size=(4, 4), pitch=(10, 10), margin=5, min_size=50, port_keepout=20):
+    D = _copy(D)
+    H = pg.rectangle(size=hole_size, layer=hole_layer)
+    H.move(origin=H.center, destination=(0, 0))
+    H.name = 'hole'
+    H.info['cheese'] = tuple(layer) if np.size(layer) == 2 else layer
+    ports = _port_segments(D, np.hypot(*hole_size) / 2 + port_keepout)
+    for cell in _unique_cells(D):
+        if any(ref.parent.info.get('cheese') == H.info['cheese'] for ref in cell.references):
+            continue
+        S = PolygonStore.from_cell(cell).extract([layer])
+        if len(S) == 0:
+            continue
+        sizes = S.bboxes()[:, 1] - S.bboxes()[:, 0]
+        for n in np.flatnonzero(np.all(sizes >= min_size, axis=1)):
+            mask, xs, ys = _holes(S[n], hole_size, pitch, margin, ports[cell.uid], port_keepout)
+            for row, col, rows, cols in _blocks(mask):
+                ref = cell.add_array(H, columns=int(cols), rows=int(rows), spacing=pitch)
+                ref.move((xs[col], ys[row]))
+    return D
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+import hashlib
+import numpy as np
+import gdspy
+from concurrent.futures import ProcessPoolExecutor
+from phidl import Device
+import phidl.geometry as pg
+from .polystore import PolygonStore, _origins
+from .spatial import SpatialIndex, _Grid, _bucket
+
+def _mix(v):
+    # splitmix64 finalizer, wraps around like the C version
+    v = np.array(v, dtype=np.uint64)
+    v ^= v >> np.uint64(30)
+    v *= np.uint64(0xbf58476d1ce4e5b9)
+    v ^= v >> np.uint64(27)
+    v *= np.uint64(0x94d049bb133111eb)
+    v ^= v >> np.uint64(31)
+    return v
+
+def _keys(S, grid):
+    # Hash of every polygon on the grid, independent of its starting vertex and orientation.
+    # A polygon is hashed as the set of its undirected edges, degenerate edges are left out.
+    if len(S) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    q = np.round(S.vertices / grid).astype(np.int64).view(np.uint64)
+    h = _mix(q[:, 0] * np.uint64(0x9e3779b97f4a7c15) + q[:, 1])
+    nxt = np.arange(1, len(h) + 1)
+    nxt[S.offsets[1:] - 1] = S.offsets[:-1]
+    lo, hi = np.minimum(h, h[nxt]), np.maximum(h, h[nxt])
+    edges = _mix(lo * np.uint64(0x9e3779b97f4a7c15) + hi)
+    edges[lo == hi] = 0
+    spec = (S.layers.astype(np.uint64) << np.uint64(32)) | S.datatypes.astype(np.uint64)
+    return _mix(np.add.reduceat(edges, S.offsets[:-1]) ^ _mix(spec))
+
+def _ranked(keys):
+    # Makes repeated keys distinct by their rank, so that matching them cancels copies one to one
+    order = np.argsort(keys, kind='stable')
+    k = keys[order]
+    first = np.r_[True, k[1:] != k[:-1]]
+    rank = np.arange(len(k)) - np.maximum.accumulate(np.where(first, np.arange(len(k)), 0))
+    out = np.empty_like(keys)
+    out[order] = _mix(k ^ _mix(rank))
+    return out
+
+def _cancel(A, B, grid):
+    # Removes the polygons present in both stores
+    ka, kb = _ranked(_keys(A, grid)), _ranked(_keys(B, grid))
+    return A.take(~np.isin(ka, kb)), B.take(~np.isin(kb, ka))
+
+def _combine(columns):
+    # Hash of the rows of a list of equally long integer arrays
+    h = np.zeros(len(columns[0]), dtype=np.uint64)
+    for c in columns:
+        h = _mix(h ^ _mix(np.asarray(c).astype(np.int64).view(np.uint64)))
+    return h
+
+def _references(cell, grid, ctx):
+    # Hashes of the placement (transformation, origin and array lattice) and of the placement together with
+    # the referenced cell, for every reference of cell
+    hashes, memo, cache, stats = ctx
+    key = ('references', cell.uid)
+    if key not in memo:
+        refs = cell.references
+        table = np.array([(ref.rotation or 0, ref.magnification or 1, bool(ref.x_reflection), ref.origin[0],
+                           ref.origin[1], getattr(ref, 'columns', 1), getattr(ref, 'rows', 1))
+                          + (tuple(ref.spacing) if getattr(ref, 'columns', 1) * getattr(ref, 'rows', 1) > 1 else (0, 0))
+                          for ref in refs], dtype=float).reshape(-1, 9)
+        table[:, 0] = np.round(table[:, 0] % 360, 9) * 1e9
+        table[:, 1] *= 1e9
+        table[:, [3, 4, 7, 8]] /= grid
+        placement = _combine(list(np.round(table).T))
+        children = np.array([int(_hash(ref.parent, grid, ctx)[:16], 16) for ref in refs], dtype=np.uint64)
+        memo[key] = (placement, _mix(children ^ placement))
+    return memo[key]
+
+def _hash(cell, grid, ctx):
+    # Content hash of a cell, equal for cells with the same polygons and references to equal cells
+    hashes = ctx[0]
+    if cell.uid not in hashes:
+        h = hashlib.sha1(np.sort(_keys(PolygonStore.from_cell(cell), grid)).tobytes())
+        h.update(np.sort(_references(cell, grid, ctx)[1]).tobytes())
+        hashes[cell.uid] = h.hexdigest()
+    return hashes[cell.uid]
+
+def _residual(a, b, grid, ctx):
+    # Polygons of cells a and b that are left after removing everything they have in common, each in
+    # its own cell's coordinates. References in the same place are compared recursively, identical
+    # cells and references are skipped without looking at their contents.
+    hashes, memo, cache, stats = ctx
+    key = (a.uid, b.uid)
+    if key in memo:
+        return memo[key]
+    empty = PolygonStore()
+    if a is b or _hash(a, grid, ctx) == _hash(b, grid, ctx):
+        stats['skipped_cells'] += 1
+        memo[key] = (empty, empty)
+        return memo[key]
+
+    # Matching references cancel one to one, the rest are paired up by placement
+    (pa, ka), (pb, kb) = _references(a, grid, ctx), _references(b, grid, ctx)
+    ka, kb = _ranked(ka), _ranked(kb)
+    left = [np.flatnonzero(~np.isin(ka, kb)), np.flatnonzero(~np.isin(kb, ka))]
+    stats['skipped_references'] += len(ka) - len(left[0])
+    placed = [{}, {}]
+    for side, cell, p in ((0, a, pa), (1, b, pb)):
+        for i in left[side]:
+            placed[side].setdefault(p[i], []).append(cell.references[i])
+
+    parts = [[PolygonStore.from_cell(a)], [PolygonStore.from_cell(b)]]
+    unpaired = [[], []]
+    for p in set(placed[0]) | set(placed[1]):
+        ra, rb = placed[0].get(p, []), placed[1].get(p, [])
+        # Different cells placed the same way are compared in their own coordinates
+        for x, y in zip(ra, rb):
+            origins = _origins(x)
+            for side, S in enumerate(_residual(x.parent, y.parent, grid, ctx)):
+                parts[side].append(S.placed(origins, x.rotation or 0, x.magnification or 1, x.x_reflection))
+        n = min(len(ra), len(rb))
+        unpaired[0] += ra[n:]
+        unpaired[1] += rb[n:]
+    for side in (0, 1):
+        parts[side].append(PolygonStore.from_references(unpaired[side], cache=cache))
+    A, B = _cancel(PolygonStore.concatenate(parts[0]), PolygonStore.concatenate(parts[1]), grid)
+    memo[key] = (A, B)
+    return memo[key]
+
+def _touching(index, top, boxes, spec):
+    # Number of polygons on spec touching each of the boxes (k, 4) in the device of a SpatialIndex, whose
+    # synced top cell is top, copies of a polygon counted separately
+    S, rows = index._query(top, boxes, [spec])
+    if len(S) == 0:
+        return np.zeros(len(boxes), dtype=np.int64)
+    b, q = S.bboxes().reshape(-1, 4), boxes[rows]
+    hit = (b[:, 0] <= q[:, 2]) & (b[:, 2] >= q[:, 0]) & (b[:, 1] <= q[:, 3]) & (b[:, 3] >= q[:, 1])
+    return np.bincount(rows[hit], minlength=len(boxes))
+
+def _overlapped(S, indices, precision):
+    # Which residual polygons of S overlap cancelled geometry of their layer in the indexed devices. Cancelling
+    # is only sound where the cancelled geometry overlaps nothing that is left over, otherwise the union of
+    # the layer differs from the union of what is left. Geometry touching a residual polygon's bbox that is
+    # not itself residual was cancelled. Boxes are shrunk by half the grid, so abutting polygons don't count.
+    bboxes = S.bboxes().reshape(-1, 4)
+    shrink = np.minimum(precision / 2, (bboxes[:, 2:] - bboxes[:, :2]) / 2)
+    boxes = np.c_[bboxes[:, :2] + shrink, bboxes[:, 2:] - shrink]
+    out = np.zeros(len(S), dtype=bool)
+    tops = [index._update() for index in indices]
+    spec = np.stack([S.layers, S.datatypes], axis=1)
+    for l, d in np.unique(spec, axis=0):
+        sel = np.flatnonzero((spec[:, 0] == l) & (spec[:, 1] == d))
+        grid = _Grid(_bucket(bboxes[sel]))
+        grid.extend(bboxes[sel], np.arange(len(sel)))
+        residual = np.bincount(grid.pairs(boxes[sel])[0], minlength=len(sel))
+        total = sum(_touching(index, top, boxes[sel], (int(l), int(d))) for index, top in zip(indices, tops))
+        out[sel] = total > residual
+    return out
+
+def _xor_tile(job):
+    a, b, box, precision = job
+    xor = gdspy.boolean(a, b, 'xor', precision=precision)
+    if xor is None:
+        return []
+    clipped = gdspy.boolean(xor, gdspy.Rectangle(*box), 'and', precision=precision)
+    return [] if clipped is None else clipped.polygons
+
+# Compares the geometry of two layouts by XOR, tile by tile
+#   A, B --> Devices or paths to GDS files
+#   tile --> size of the square tiles the remaining differences are XOR-ed in
+#   layers --> layers to compare, as ints or (layer, datatype) tuples, all layers if None
+#   precision --> database grid, coordinates are compared after rounding to it
+#   tolerance --> differences thinner than this are ignored, defaults to precision
+#   diff_layer --> layer of the difference polygons, by default they stay on their own layers
+#   workers --> number of processes for the tiles, 1 runs them in this process
+#
+# Cells with the same content hash are skipped, references to equal cells in the same place cancel and
+# references to different cells in the same place are compared recursively. Whatever polygons do not
+# have an identical twin on the other side are XOR-ed per layer and tile with gdspy. Tiles where those
+# polygons overlap cancelled geometry of their layer XOR all polygons of A and B in the tile instead, they
+# are counted in report['full_tiles'].
+# Returns a report dict and a Device with the differences.
+def compare(A, B, tile=200, layers=None, precision=1e-3, tolerance=None, diff_layer=None, workers=None):
+    if isinstance(A, str):
+        A = pg.import_gds(A, flatten=False)
+    if isinstance(B, str):
+        B = pg.import_gds(B, flatten=False)
+    tolerance = precision if tolerance is None else tolerance
+    stats = {'skipped_cells': 0, 'skipped_references': 0}
+    RA, RB = _residual(A, B, precision, ({}, {}, {}, stats))
+    if layers is not None:
+        RA, RB = RA.extract(layers), RB.extract(layers)
+
+    # Every polygon goes to all tiles its bounding box touches
+    jobs, specs = [], []
+    full = 0
+    S = PolygonStore.concatenate([RA, RB])
+    if len(S):
+        side = np.r_[np.zeros(len(RA), dtype=int), np.ones(len(RB), dtype=int)]
+        indices = SpatialIndex(A), SpatialIndex(B)
+        overlapped = _overlapped(S, indices, precision)
+        bboxes = S.bboxes()
+        i0, j0 = np.floor(bboxes[:, 0] / tile).astype(np.int64).T
+        i1, j1 = np.floor(bboxes[:, 1] / tile).astype(np.int64).T
+        ni, nj = i1 - i0 + 1, j1 - j0 + 1
+        poly = np.repeat(np.arange(len(S)), ni * nj)
+        k = np.arange(len(poly)) - np.repeat(np.cumsum(ni * nj) - ni * nj, ni * nj)
+        ti, tj = i0[poly] + k % ni[poly], j0[poly] + k // ni[poly]
+        cells = np.stack([S.layers[poly], S.datatypes[poly], ti, tj], axis=1)
+        cells, inverse = np.unique(cells, axis=0, return_inverse=True)
+        order = np.argsort(inverse.ravel(), kind='stable')
+        bounds = np.r_[0, np.cumsum(np.bincount(inverse.ravel(), minlength=len(cells)))]
+        for n, (l, d, i, j) in enumerate(cells):
+            members = poly[order[bounds[n]:bounds[n + 1]]]
+            box = ((i * tile, j * tile), ((i + 1) * tile, (j + 1) * tile))
+            if overlapped[members].any():
+                a, b = [list(index.query(box, layers=[(int(l), int(d))])) for index in indices]
+                full += 1
+            else:
+                a = [S[m] for m in members if side[m] == 0]
+                b = [S[m] for m in members if side[m] == 1]
+            jobs.append((a, b, box, precision))
+            specs.append((int(l), int(d)))
+
+    if workers == 1 or len(jobs) < 2:
+        results = [_xor_tile(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_xor_tile, jobs, chunksize=max(1, len(jobs) // 64)))
+
+    D = Device('xor')
+    report = {'identical': True, 'tiles': len(jobs), 'full_tiles': full, 'layers': {}}
+    report.update(stats)
+    diffs = {}
+    for spec, polygons in zip(specs, results):
+        for p in polygons:
+            x, y = p.T
+            area = abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2
+            perimeter = np.sum(np.hypot(*(np.roll(p, -1, axis=0) - p).T))
+            if area > tolerance * perimeter / 2:
+                diffs.setdefault(spec, []).append((p, area))
+    for spec, items in sorted(diffs.items()):
+        polygons = [p for p, _ in items]
+        points = np.concatenate(polygons)
+        report['identical'] = False
+        report['layers'][spec] = {'polygons': len(polygons), 'area': sum(a for _, a in items),
+                                  'bbox': np.array([points.min(axis=0), points.max(axis=0)])}
+        layer, datatype = spec if diff_layer is None else (diff_layer, 0)
+        D.add(gdspy.PolygonSet(polygons, layer=layer, datatype=datatype))
+    return report, D
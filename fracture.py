@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import gdspy
+from concurrent.futures import ProcessPoolExecutor
+from phidl import Device
+from .polystore import PolygonStore, _origins
+from .spatial import SpatialIndex, _Grid, _bucket
+
+def _matrix(ref, origin):
+    # Affine matrix of one instance of a reference: reflection, magnification, rotation, then the origin
+    t = np.radians(ref.rotation or 0)
+    m = ref.magnification or 1
+    s = -1 if ref.x_reflection else 1
+    return np.array([[m*np.cos(t), -s*m*np.sin(t), origin[0]], [m*np.sin(t), s*m*np.cos(t), origin[1]], [0, 0, 1]])
+
+def _apply(S, M):
+    return PolygonStore(S.vertices @ M[:2, :2].T + M[:2, 2], S.offsets, S.layers, S.datatypes)
+
+def _simplified(S, precision):
+    # Store without repeated vertices and vertices in the middle of straight edges. Both are tested exactly on
+    # the database grid, so the polygons do not change.
+    q = np.round(S.vertices / precision).astype(np.int64)
+    for step in ('repeated', 'straight'):
+        nxt = np.arange(1, len(q) + 1)
+        nxt[S.offsets[1:] - 1] = S.offsets[:-1]
+        prv = np.empty_like(nxt)
+        prv[nxt] = np.arange(len(nxt))
+        u, v = q - q[prv], q[nxt] - q
+        if step == 'repeated':
+            drop = np.all(u == 0, axis=1)
+        else:
+            drop = (u[:, 0]*v[:, 1] - u[:, 1]*v[:, 0] == 0) & (np.sum(u*v, axis=1) > 0)
+        keep = ~drop
+        counts = np.add.reduceat(keep, S.offsets[:-1]) if len(S) else np.zeros(0, dtype=np.int64)
+        S = PolygonStore(S.vertices[keep], np.r_[0, np.cumsum(counts)], S.layers, S.datatypes)
+        q = q[keep]
+    keep = S.counts >= 3
+    return S.take(keep)
+
+def _slabs(S):
+    # Horizontal trapezoids (polygon, y0, y1, xl0, xr0, xl1, xr1) of the polygons of S. Every polygon is cut
+    # at the heights of its vertices, the crossings of each slab are paired left to right and trapezoids
+    # bounded by the same two edges in consecutive slabs are merged.
+    nxt = np.arange(1, len(S.vertices) + 1)
+    nxt[S.offsets[1:] - 1] = S.offsets[:-1]
+    poly = np.repeat(np.arange(len(S)), S.counts)
+    a, b = S.vertices, S.vertices[nxt]
+    ys, rank = np.unique(S.vertices[:, 1], return_inverse=True)
+    rank = rank.ravel()
+    levels = np.unique(poly * len(ys) + rank)
+    edge = np.flatnonzero(a[:, 1] != b[:, 1])
+    lo = poly[edge] * len(ys) + np.minimum(rank[edge], rank[nxt[edge]])
+    hi = poly[edge] * len(ys) + np.maximum(rank[edge], rank[nxt[edge]])
+    i0, i1 = np.searchsorted(levels, lo), np.searchsorted(levels, hi)
+    n = i1 - i0
+    e = np.repeat(edge, n)
+    s = np.repeat(i0 - np.cumsum(n) + n, n) + np.arange(len(e))
+    y0, y1 = ys[levels[s] % len(ys)], ys[levels[s + 1] % len(ys)]
+    (xa, ya), (xb, yb) = a[e].T, b[e].T
+    x0 = xa + (y0 - ya) * (xb - xa) / (yb - ya)
+    x1 = xa + (y1 - ya) * (xb - xa) / (yb - ya)
+    order = np.lexsort((x0 + x1, s))
+    left, right = order[0::2], order[1::2]
+
+    # Runs of the same edge pair over consecutive slabs become one trapezoid
+    key = np.lexsort((s[left], e[right], e[left]))
+    left, right = left[key], right[key]
+    new = np.r_[True, (e[left][1:] != e[left][:-1]) | (e[right][1:] != e[right][:-1]) | (s[left][1:] != s[left][:-1] + 1)]
+    first = np.flatnonzero(new)
+    last = np.r_[first[1:], len(left)] - 1
+    fl, fr, ll, lr = left[first], right[first], left[last], right[last]
+    return np.stack([poly[e[fl]], y0[fl], y1[ll], x0[fl], x0[fr], x1[ll], x1[lr]], axis=1)
+
+def _trapezoids(S, sliver):
+    # Trapezoids of the polygons of S, each polygon is cut horizontally or vertically, whichever leaves fewer
+    # slivers (trapezoids lower or narrower than sliver) and then fewer trapezoids
+    if len(S) == 0:
+        return np.zeros((0, 4, 2))
+    results = []
+    for axis in (0, 1):
+        T = _slabs(S if axis == 0 else PolygonStore(S.vertices[:, ::-1], S.offsets))
+        thin = (T[:, 2] - T[:, 1] < sliver) | (np.maximum(T[:, 4] - T[:, 3], T[:, 6] - T[:, 5]) < sliver)
+        poly = T[:, 0].astype(np.int64)
+        results.append((T, poly, np.bincount(poly[thin], minlength=len(S)), np.bincount(poly, minlength=len(S))))
+    (H, ph, sh, nh), (V, pv, sv, nv) = results
+    vertical = (sv < sh) | ((sv == sh) & (nv < nh))
+    H, V = H[~vertical[ph]], V[vertical[pv]]
+    corners = lambda T: np.stack([np.c_[T[:, 3], T[:, 1]], np.c_[T[:, 4], T[:, 1]],
+                                  np.c_[T[:, 6], T[:, 2]], np.c_[T[:, 5], T[:, 2]]], axis=1)
+    return np.concatenate([corners(H), corners(V)[:, ::-1, ::-1]])
+
+def _fracture_job(job):
+    polygons, box, precision, sliver = job
+    if box is not None:
+        polygons = gdspy.boolean(polygons, gdspy.Rectangle(*box), 'and', precision=precision)
+    elif len(polygons) > 1:
+        polygons = gdspy.boolean(polygons, None, 'or', precision=precision)
+    if polygons is None:
+        return np.zeros((0, 4, 2))
+    polygons = polygons.polygons if hasattr(polygons, 'polygons') else polygons
+    return _trapezoids(_simplified(PolygonStore.from_polygons(polygons), precision), sliver)
+
+def _walk(cell, M, ctx):
+    # Places the polygons of cell with M, instances that fit into one write field at a right angle are
+    # put aside to be fractured once per unique cell, the others are walked into. Instances within half a
+    # grid step of a field line are on it once written, so they still fit.
+    origin, WF, precision, layers, flat, loose, instances = ctx
+    loose.append(_apply(PolygonStore.from_cell(cell).extract(layers) if layers else PolygonStore.from_cell(cell), M))
+    for ref in cell.references:
+        S = PolygonStore.from_device(ref.parent, layers=layers, cache=flat)
+        if len(S) == 0:
+            continue
+        for o in _origins(ref):
+            Mi = M @ _matrix(ref, o)
+            corners = np.array([[x, y, 1] for x in S.bbox[:, 0] for y in S.bbox[:, 1]]) @ Mi[:2].T
+            lo, hi = corners.min(axis=0), corners.max(axis=0)
+            one = np.all(np.floor((lo - origin + precision/2) / WF) >= np.ceil((hi - origin - precision/2) / WF) - 1)
+            square = np.isclose(Mi[0, 0] * Mi[0, 1], 0)
+            if one and square:
+                instances.append((ref.parent, Mi, lo, hi))
+            else:
+                _walk(ref.parent, Mi, ctx)
+
+# Fractures a layout into trapezoids that do not cross write field boundaries
+#   D --> Device to fracture, it is not changed
+#   layers --> layers to fracture, as ints or (layer, datatype) tuples, all layers if None
+#   WF --> write field size, the fields are those of misc.stiches
+#   WA --> Device whose bounding box sets the write field grid, the bounding box of D if None
+#   sliver --> trapezoids lower or narrower than this count as slivers
+#   precision --> database grid of the boolean operations, the field lines are snapped to it
+#   workers --> number of processes for the fields, 1 runs them in this process
+#
+# Polygons are clipped to the fields they touch, merged, and cut at the heights of their vertices into
+# slabs. Slabs bounded by the same two edges are merged back into one trapezoid. Every polygon is cut both
+# horizontally and vertically, and the cut with fewer slivers is kept.
+# References that fit into one field at a multiple of 90 degrees, with nothing else on their layers
+# overlapping them, are fractured once per unique cell and stay references to the fractured cell.
+# Everything else is flattened into the fields.
+# Returns a Device with the trapezoids on their original layers.
+def fracture(D, layers=None, WF=100, WA=None, sliver=0.01, precision=1e-3, workers=None):
+    flat = {}
+    # The field lines are snapped to the database grid, so that the clipped pieces end exactly on them
+    snap = lambda p: np.round(np.asarray(p, dtype=float) / precision) * precision
+    origin = snap((WA.bbox if WA else SpatialIndex(D).bbox)[0])
+    loose, instances = [], []
+    _walk(D, np.eye(3), (origin, WF, precision, layers, flat, loose, instances))
+    S = PolygonStore.concatenate(loose)
+
+    # Instances overlapping anything else on one of their layers are flattened after all
+    specs = lambda T: set(zip(T.layers.tolist(), T.datatypes.tolist()))
+    owned = [PolygonStore.from_device(cell, layers=layers, cache=flat) for cell, _, _, _ in instances]
+    boxes = np.array([np.r_[lo, hi] for _, _, lo, hi in instances]).reshape(-1, 4)
+    have = [specs(T) for T in owned]
+    clash = np.zeros(len(instances), dtype=bool)
+    for spec in specs(S).union(*have):
+        mine = np.array([spec in h for h in have], dtype=bool)
+        where = np.flatnonzero((S.layers == spec[0]) & (S.datatypes == spec[1]))
+        entries = np.concatenate([boxes[mine], S.take(where).bboxes().reshape(-1, 4)])
+        ids = np.r_[np.flatnonzero(mine), -1 - np.arange(len(where))]
+        if len(entries) < 2 or not mine.any():
+            continue
+        grid = _Grid(_bucket(entries))
+        grid.extend(entries, ids)
+        query = boxes[mine] + (precision, precision, -precision, -precision)
+        rows, hits = grid.pairs(query)
+        own = np.flatnonzero(mine)
+        clash[own[rows[hits != own[rows]]]] = True
+    S = PolygonStore.concatenate([S] + [_apply(T, Mi) for T, (_, Mi, _, _), c in zip(owned, instances, clash) if c])
+    instances = [i for i, c in zip(instances, clash) if not c]
+
+    # One job per spec and field for the loose polygons, one per spec and unique cell for the instances
+    jobs, targets = [], []
+    if len(S):
+        bboxes = S.bboxes()
+        i0, j0 = np.floor((bboxes[:, 0] - origin) / WF).astype(np.int64).T
+        i1, j1 = np.maximum(np.ceil((bboxes[:, 1] - origin) / WF).astype(np.int64).T - 1, (i0, j0))
+        ni, nj = i1 - i0 + 1, j1 - j0 + 1
+        poly = np.repeat(np.arange(len(S)), ni * nj)
+        k = np.arange(len(poly)) - np.repeat(np.cumsum(ni * nj) - ni * nj, ni * nj)
+        cells = np.stack([S.layers[poly], S.datatypes[poly], i0[poly] + k % ni[poly], j0[poly] + k // ni[poly]], axis=1)
+        cells, inverse = np.unique(cells, axis=0, return_inverse=True)
+        order = np.argsort(inverse.ravel(), kind='stable')
+        bounds = np.r_[0, np.cumsum(np.bincount(inverse.ravel(), minlength=len(cells)))]
+        for n, (l, d, i, j) in enumerate(cells):
+            box = (snap(origin + WF * np.array([i, j])), snap(origin + WF * np.array([i + 1, j + 1])))
+            jobs.append(([S[m] for m in poly[order[bounds[n]:bounds[n + 1]]]], box, precision, sliver))
+            targets.append((None, int(l), int(d)))
+    unique = {cell.uid: cell for cell, _, _, _ in instances}
+    for uid, cell in unique.items():
+        for (l, d), polygons in PolygonStore.from_device(cell, layers=layers, cache=flat).get_polygons(by_spec=True).items():
+            jobs.append((polygons, None, precision, sliver))
+            targets.append((uid, l, d))
+
+    if workers == 1 or len(jobs) < 2:
+        results = [_fracture_job(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_fracture_job, jobs, chunksize=max(1, len(jobs) // 64)))
+
+    out = Device('fractured')
+    cells = {uid: Device('fractured_' + cell.name) for uid, cell in unique.items()}
+    parts = {}
+    for (uid, l, d), T in zip(targets, results):
+        parts.setdefault(uid, []).append(PolygonStore(T.reshape(-1, 2), 4 * np.arange(len(T) + 1), l, d))
+    for uid, stores in parts.items():
+        target = out if uid is None else cells[uid]
+        for spec, polygons in PolygonStore.concatenate(stores).get_polygons(by_spec=True).items():
+            target.add(gdspy.PolygonSet(polygons, layer=spec[0], datatype=spec[1]))
+    for cell, Mi, _, _ in instances:
+        ref = out.add_ref(cells[cell.uid])
+        ref.x_reflection = bool(np.linalg.det(Mi[:2, :2]) < 0)
+        ref.magnification = float(np.hypot(Mi[0, 0], Mi[1, 0]))
+        ref.rotation = float(np.degrees(np.arctan2(Mi[1, 0], Mi[0, 0])))
+        ref.origin = Mi[:2, 2].copy()
+    return out
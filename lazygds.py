@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+
+import mmap
+import struct
+import numpy as np
+import gdspy
+from gdspy.gdsiiformat import _eight_byte_real_to_float
+from .polystore import PolygonStore
+
+_ELEMENTS = (0x0800, 0x0900, 0x0A00, 0x0B00, 0x0C00, 0x1500, 0x2D00)
+_CHUNK = 1 << 22
+
+def _scan(words, pattern, step=1):
+    # Word indices at which the (pattern length) words match, None in pattern matches anything.
+    # The file is scanned in chunks so that the masks stay small.
+    found = []
+    n, m = len(words), len(pattern)
+    for c in range(0, n, _CHUNK):
+        w = words[c:c + _CHUNK + m - 1]
+        k = len(w) - m + 1
+        if k <= 0:
+            break
+        mask = np.ones(k, dtype=bool)
+        for j, v in enumerate(pattern):
+            if v is None:
+                continue
+            if isinstance(v, tuple):
+                mask &= np.isin(w[j:j + k], v)
+            else:
+                mask &= w[j:j + k] == v
+        found.append(np.flatnonzero(mask) + c)
+    return np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+
+def _layer_mask(layers, datatypes, which):
+    # Same selection as PolygonStore.extract, ints select layers and (layer, datatype) tuples select specs
+    if which is None:
+        return np.ones(len(layers), dtype=bool)
+    keep = np.zeros(len(layers), dtype=bool)
+    for l in ([which] if np.isscalar(which) else which):
+        if np.size(l) == 2:
+            keep |= (layers == l[0]) & (datatypes == l[1])
+        else:
+            keep |= layers == l
+    return keep
+
+def _touching(bboxes, box):
+    if box is None:
+        return np.ones(len(bboxes), dtype=bool)
+    return ((bboxes[:, 0] <= box[1][0]) & (bboxes[:, 2] >= box[0][0]) &
+            (bboxes[:, 1] <= box[1][1]) & (bboxes[:, 3] >= box[0][1]))
+
+def _transform(points, rotation, magnification, x_reflection):
+    points = np.array(points, dtype=float)
+    if x_reflection:
+        points[:, 1] *= -1
+    ca, sa = np.cos(np.radians(rotation)), np.sin(np.radians(rotation))
+    return magnification * points @ np.array([[ca, sa], [-sa, ca]])
+
+def _corners(box):
+    return np.array([box[0], [box[0][0], box[1][1]], box[1], [box[1][0], box[0][1]]], dtype=float)
+
+class _Cell(object):
+    # Index of one cell, with everything known about it before any of its polygons is decoded
+    #   xy, counts, layers, datatypes, bboxes --> XY record offset, vertex count, layer and bounding box of
+    #                                             each boundary, as (xmin, ymin, xmax, ymax) rows
+    #   others --> elements that are not plain boundaries (paths, boxes, split XY records), decoded by gdspy
+    #   refs --> (child, rotation, magnification, x_reflection) : (m, 2) origins of all references and array elements
+    def __init__(self, name, start, end):
+        self.name, self.start, self.end = name, start, end
+        self.xy = self.counts = self.layers = self.datatypes = np.zeros(0, dtype=np.int64)
+        self.bboxes = np.zeros((0, 4))
+        self.others, self.refs = [], {}
+        self.bbox = None
+
+# Read-only view of a GDS file that only decodes what is asked for
+#   filename --> GDS file, memory mapped
+#   cellname --> top cell, has to be given if the file has more than one
+#
+# Opening the file finds the cells and the layer, position and bounding box of every boundary with
+# vectorized scans over the mapped file, and reads references. Polygons are decoded when they are
+# queried, and only those of the cells and the region asked for, so huge layouts can be used as the
+# obstacle or write area of the fill and stitch functions without loading them into Devices.
+# The file stays mapped until close(), or the end of a with block.
+class LazyLayout(object):
+
+    def __init__(self, filename, cellname=None):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._words = np.frombuffer(self._data, dtype='>u2', count=len(self._data) // 2)
+        first = self._header()
+        self._cells = self._index(first)
+        self._bbox = {}
+        for name in self._cells:
+            self._cell_bbox(name)
+        children = {child for c in self._cells.values() for child, _, _, _ in c.refs}
+        tops = [name for name in self._cells if name not in children]
+        if cellname is not None:
+            if cellname not in self._cells:
+                raise ValueError('[DeviceLib] LazyLayout() The requested cell (named %s) is not present in file %s'
+                                 % (cellname, filename))
+            self.top = cellname
+        elif len(tops) == 1:
+            self.top = tops[0]
+        else:
+            raise ValueError('[DeviceLib] LazyLayout() There are %d top-level cells, you must specify `cellname` '
+                             'to select one of them' % len(tops))
+
+    def _header(self):
+        # Reads the library records up to the first cell
+        p = 0
+        while p + 4 <= len(self._data):
+            n, rtype = struct.unpack_from('>HH', self._data, p)
+            if rtype == 0x0305:
+                body = self._data[p + 4:p + n]
+                self.precision = _eight_byte_real_to_float(body[8:16])
+                self.unit = self.precision / _eight_byte_real_to_float(body[:8])
+            elif rtype in (0x0502, 0x0400):
+                self._scale = self.precision / self.unit
+                return p
+            p += n
+        raise ValueError('[DeviceLib] LazyLayout() %s is not a GDS file' % self.filename)
+
+    def _index(self, first):
+        w = self._words
+        # Cells begin with a 28 byte BGNSTR record right after the ENDSTR of the previous cell
+        begins = 2 * _scan(w, (0x001C, 0x0502))
+        begins = begins[begins >= first]
+        prev = (begins - 4) // 2
+        begins = begins[(begins == first) | ((w[prev] == 0x0004) & (w[prev + 1] == 0x0700))]
+        tail = 2 * _scan(w[-2048:], (0x0004, 0x0400))
+        if len(begins) == 0 or len(tail) == 0:
+            return self._walk_library(first)
+        endlib = len(w) * 2 - 2 * len(w[-2048:]) + tail[-1]
+        ends = np.r_[begins[1:], endlib] - 4
+        if not np.all((w[ends // 2] == 0x0004) & (w[ends // 2 + 1] == 0x0700)):
+            return self._walk_library(first)
+
+        cells = {}
+        for start, end in zip(begins, ends):
+            n = int(w[(start + 28) // 2])
+            name = self._data[start + 32:start + 28 + n].rstrip(b'\0').decode('ascii')
+            cells[name] = _Cell(name, start + 28 + n, end)
+        # Elements follow the STRNAME of their cell or the ENDEL of the previous element
+        starts = 2 * _scan(w, (0x0004, 0x1100, 0x0004, _ELEMENTS)) + 4
+        lo = np.array([c.start for c in cells.values()])
+        hi = np.array([c.end for c in cells.values()])
+        owner = np.searchsorted(lo, starts, side='right') - 1
+        inside = (owner >= 0) & (starts < hi[owner])
+        starts, owner = starts[inside], owner[inside]
+        bounds = np.searchsorted(owner, np.arange(len(cells) + 1))
+        for k, cell in enumerate(cells.values()):
+            s = starts[bounds[k]:bounds[k + 1]]
+            if cell.start < cell.end:
+                s = np.r_[cell.start, s]
+            if not self._classify(cell, s):
+                self._classify(cell, self._walk_cell(cell))
+        return cells
+
+    def _walk_library(self, first):
+        # Record by record fallback for files the scan cannot make sense of
+        cells, p = {}, first
+        while True:
+            n, rtype = struct.unpack_from('>HH', self._data, p)
+            if rtype == 0x0400:
+                return cells
+            if rtype == 0x0606:
+                name = self._data[p + 4:p + n].rstrip(b'\0').decode('ascii')
+                start = p + n
+            if rtype == 0x0700:
+                cells[name] = _Cell(name, start, p)
+                self._classify(cells[name], self._walk_cell(cells[name]))
+            p += n
+
+    def _walk_cell(self, cell):
+        starts, p = [], cell.start
+        while p < cell.end:
+            starts.append(p)
+            p = self._element(p)[1] + 4
+        return np.array(starts, dtype=np.int64)
+
+    def _classify(self, cell, starts):
+        # Fills the index of cell from its element positions, plain boundaries are read with array operations.
+        # Returns False if the elements do not chain up from the start to the end of the cell.
+        if len(starts) == 0:
+            return cell.start == cell.end
+        w = self._words
+        q = starts // 2
+        kind = w[q + 1]
+        plain = ((kind == 0x0800) & (w[q + 2] == 6) & (w[q + 3] == 0x0D02) & (w[q + 5] == 6)
+                 & (w[q + 6] == 0x0E02) & (w[q + 9] == 0x1003))
+        xylen = np.where(plain, w[q + 8], 0).astype(np.int64)
+        ends = starts + 16 + xylen
+        e = np.minimum(ends // 2, len(w) - 2)
+        plain &= (w[e] == 0x0004) & (w[e + 1] == 0x1100)
+        others = []
+        for i in np.flatnonzero(~plain):
+            fields, ends[i] = self._element(starts[i])
+            others.append(fields)
+        if not np.array_equal(ends + 4, np.r_[starts[1:], cell.end]):
+            return False
+
+        qp = q[plain]
+        cell.xy = starts[plain] + 20
+        cell.counts = xylen[plain] // 8 - 1
+        cell.layers = w[qp + 4].astype(np.uint16).view(np.int16).astype(np.int32)
+        cell.datatypes = w[qp + 7].astype(np.uint16).view(np.int16).astype(np.int32)
+        cell.bboxes = np.zeros((len(cell.xy), 4))
+        vertices = np.cumsum(cell.counts)
+        for chunk in np.array_split(np.arange(len(cell.xy)), max(1, int(vertices[-1] // _CHUNK) + 1) if len(vertices) else 1):
+            if len(chunk):
+                S = self._boundaries(cell, chunk)
+                cell.bboxes[chunk] = S.bboxes().reshape(-1, 4)
+
+        cell.others, cell.refs = [], {}
+        for fields in others:
+            if fields['type'] in (0x0A, 0x0B):
+                key = (fields['sname'], fields.get('rotation', 0), fields.get('magnification', 1),
+                       fields.get('x_reflection', False))
+                cell.refs.setdefault(key, []).append(self._origins(fields))
+            elif fields['type'] in (0x08, 0x09, 0x2D):
+                polygons = self._polygons(fields)
+                points = np.concatenate(polygons)
+                fields['bbox'] = np.r_[points.min(axis=0), points.max(axis=0)]
+                cell.others.append(fields)
+        cell.refs = {k: np.concatenate(v) for k, v in cell.refs.items()}
+        return True
+
+    def _element(self, p):
+        # Decodes the element at byte p the way gdspy's reader does, returns its fields and the ENDEL position
+        fields = {'type': self._data[p + 2]}
+        p += 4
+        while True:
+            n, rtype = struct.unpack_from('>HH', self._data, p)
+            body = self._data[p + 4:p + n]
+            if rtype == 0x1100:
+                return fields, p
+            if rtype == 0x0D02:
+                fields['layer'] = struct.unpack('>h', body)[0]
+            elif rtype in (0x0E02, 0x2E02):
+                fields['datatype'] = struct.unpack('>h', body)[0]
+            elif rtype == 0x1003:
+                xy = np.frombuffer(body, dtype='>i4').reshape(-1, 2) * self._scale
+                fields['xy'] = np.concatenate([fields['xy'], xy]) if 'xy' in fields else xy
+            elif rtype == 0x1206:
+                fields['sname'] = body.rstrip(b'\0').decode('ascii')
+            elif rtype == 0x1302:
+                fields['columns'], fields['rows'] = struct.unpack('>hh', body)
+            elif rtype == 0x1A01:
+                fields['x_reflection'] = (struct.unpack('>H', body)[0] & 0x8000) > 0
+            elif rtype == 0x1B05:
+                fields['magnification'] = _eight_byte_real_to_float(body)
+            elif rtype == 0x1C05:
+                fields['rotation'] = _eight_byte_real_to_float(body)
+            elif rtype == 0x0F03:
+                fields['width'] = abs(struct.unpack('>i', body)[0]) * self._scale
+            elif rtype == 0x2102:
+                fields['pathtype'] = struct.unpack('>h', body)[0]
+            elif rtype == 0x3003:
+                fields['bgnextn'] = struct.unpack('>i', body)[0] * self._scale
+            elif rtype == 0x3103:
+                fields['endextn'] = struct.unpack('>i', body)[0] * self._scale
+            p += n
+
+    def _origins(self, fields):
+        xy = fields['xy']
+        if fields['type'] == 0x0A:
+            return xy[:1]
+        # The XY of an array holds its origin and the ends of its column and row vectors, already transformed
+        columns, rows = fields['columns'], fields['rows']
+        i, j = np.meshgrid(np.arange(columns), np.arange(rows))
+        return xy[0] + np.outer(i.ravel(), (xy[1] - xy[0]) / columns) + np.outer(j.ravel(), (xy[2] - xy[0]) / rows)
+
+    def _polygons(self, fields):
+        if fields['type'] != 0x09:
+            return [fields['xy'][:-1]]
+        ends = gdspy.GdsLibrary._pathtype_dict.get(fields.get('pathtype', 0), 'extended')
+        if 'bgnextn' in fields or 'endextn' in fields:
+            ends = (fields.get('bgnextn', 0), fields.get('endextn', 0))
+        path = gdspy.FlexPath(fields['xy'], fields.get('width', 0), ends=ends, gdsii_path=True)
+        return path.get_polygons()
+
+    def _boundaries(self, cell, which):
+        # Decodes the plain boundaries with the given indices into a store
+        counts = cell.counts[which]
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        pos = np.repeat(cell.xy[which] - 8 * offsets[:-1], counts) + 8 * np.arange(offsets[-1])
+        q = pos // 2
+        w = self._words
+        x = ((w[q].astype(np.uint32) << 16) | w[q + 1]).view(np.int32)
+        y = ((w[q + 2].astype(np.uint32) << 16) | w[q + 3]).view(np.int32)
+        return PolygonStore(np.stack([x, y], axis=1) * self._scale, offsets, cell.layers[which], cell.datatypes[which])
+
+    def _cell_bbox(self, name):
+        if name not in self._bbox:
+            cell = self._cells[name]
+            boxes = []
+            if len(cell.bboxes):
+                boxes.append(np.r_[cell.bboxes[:, :2].min(axis=0), cell.bboxes[:, 2:].max(axis=0)])
+            boxes += [f['bbox'] for f in cell.others]
+            for (child, rotation, magnification, x_reflection), origins in cell.refs.items():
+                bbox = self._cell_bbox(child)
+                if bbox is not None:
+                    corners = _transform(_corners(bbox), rotation, magnification, x_reflection)
+                    boxes.append(np.r_[origins.min(axis=0) + corners.min(axis=0), origins.max(axis=0) + corners.max(axis=0)])
+            self._bbox[name] = None
+            if boxes:
+                boxes = np.array(boxes)
+                self._bbox[name] = np.array([boxes[:, :2].min(axis=0), boxes[:, 2:].max(axis=0)])
+        return self._bbox[name]
+
+    def _query(self, name, box, layers):
+        # Polygons of a cell in its own coordinates, at least all of those touching box
+        cell = self._cells[name]
+        keep = np.flatnonzero(_touching(cell.bboxes, box) & _layer_mask(cell.layers, cell.datatypes, layers))
+        parts = [self._boundaries(cell, keep)] if len(keep) else []
+        for fields in cell.others:
+            l, d = fields.get('layer', 0), fields.get('datatype', 0)
+            if _touching(fields['bbox'][None, :], box)[0] and _layer_mask(np.array([l]), np.array([d]), layers)[0]:
+                parts.append(PolygonStore.from_polygons(self._polygons(fields), l, d))
+        # References sharing cell and orientation are queried once, with the region seen from all their origins
+        for (child, rotation, magnification, x_reflection), origins in cell.refs.items():
+            bbox = self._cell_bbox(child)
+            if bbox is None:
+                continue
+            corners = _transform(_corners(bbox), rotation, magnification, x_reflection)
+            lo, hi = corners.min(axis=0), corners.max(axis=0)
+            if box is not None:
+                origins = origins[_touching(np.c_[origins + lo, origins + hi], box)]
+                if len(origins) == 0:
+                    continue
+                local = _corners(np.array(box) - [origins.max(axis=0), origins.min(axis=0)])
+                local = _transform(local, -rotation, 1 / magnification, False)
+                if x_reflection:
+                    local[:, 1] *= -1
+                S = self._query(child, np.array([local.min(axis=0), local.max(axis=0)]), layers)
+            else:
+                S = self._query(child, None, layers)
+            parts.append(S.placed(origins, rotation, magnification, x_reflection))
+        return PolygonStore.concatenate(parts)
+
+    # Returns a flat store with the polygons touching region, a ((xmin, ymin), (xmax, ymax)) box, on the
+    # given layers as ints or (layer, datatype) tuples
+    def to_store(self, region=None, layers=None):
+        box = None if region is None else np.asarray(region, dtype=float)
+        S = self._query(self.top, box, layers)
+        if box is None or len(S) == 0:
+            return S
+        return S.take(_touching(S.bboxes().reshape(-1, 4), box))
+
+    def to_device(self, region=None, layers=None, name=None):
+        return self.to_store(region, layers).to_device(self.top if name is None else name)
+
+    def get_polygons(self, region=None, layers=None, by_spec=False):
+        return self.to_store(region, layers).get_polygons(by_spec)
+
+    # Unmaps the file, so that it can be overwritten or deleted. The layout cannot be queried afterwards.
+    def close(self):
+        if self._data is not None:
+            self._words = None
+            self._data.close()
+            self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def cells(self):
+        return list(self._cells)
+
+    @property
+    def bbox(self):
+        bbox = self._cell_bbox(self.top)
+        return np.zeros((2, 2)) if bbox is None else bbox
+
+    @property
+    def xmin(self):
+        return self.bbox[0][0]
+
+    @property
+    def ymin(self):
+        return self.bbox[0][1]
+
+    @property
+    def xmax(self):
+        return self.bbox[1][0]
+
+    @property
+    def ymax(self):
+        return self.bbox[1][1]
+
+    @property
+    def size(self):
+        bbox = self.bbox
+        return bbox[1] - bbox[0]
+
+    @property
+    def xsize(self):
+        return self.size[0]
+
+    @property
+    def ysize(self):
+        return self.size[1]
+
+    @property
+    def center(self):
+        return np.sum(self.bbox, 0)/2
+
+    @property
+    def x(self):
+        return self.center[0]
+
+    @property
+    def y(self):
+        return self.center[1]
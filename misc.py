@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 
-from numpy import arange, array, size
+from numpy import arange, array, ceil, meshgrid, stack, isinf
 from sys import float_info
 from phidl import Device, Path
+from phidl.device_layout import _parse_layer
 import phidl.geometry as pg
 import phidl.path as pp
 from math import pi, sin
+from .polystore import PolygonStore
+from .spatial import SpatialIndex
 
 EPS = float_info.epsilon
 
@@ -131,29 +134,39 @@ def stiches(device, which_layer, WF=100, WA=None, width=None, layer=0):
     if width is None:
         width = WF/20
     O = Device()
-    rh = pg.rectangle((device.xsize, width))
-    rv = pg.rectangle((width, device.ysize))
-    if WA:
-        warr = WA
+    #The bounding boxes are looked up once, the index knows the one of a Device without walking it again
+    if isinstance(device, Device):
+        index = SpatialIndex(device)
+        bbox = index.bbox
     else:
-        warr = device
+        bbox = device.bbox
+    wbox = WA.bbox if WA else bbox
+    rh = pg.rectangle((bbox[1][0] - bbox[0][0], width))
+    rv = pg.rectangle((width, bbox[1][1] - bbox[0][1]))
 
-    for i in arange(warr.xmin + WF, warr.xmax, WF):
+    for i in arange(wbox[0][0] + WF, wbox[1][0], WF):
         s = O << rv
         s.movex(i - width/2)
-        s.movey(origin=s.y, destination=warr.y)
-    for i in arange(warr.ymin + WF, warr.ymax, WF):
+        s.movey(origin=s.y, destination=(wbox[0][1] + wbox[1][1])/2)
+    for i in arange(wbox[0][1] + WF, wbox[1][1], WF):
         s = O << rh
         s.movey(i - width/2)
-        s.movex(origin=s.x, destination=warr.x)
+        s.movex(origin=s.x, destination=(wbox[0][0] + wbox[1][0])/2)
 
-    to_stitch = pg.extract(device, layers=which_layer)
+    #Only the polygons under the stitches take part in the boolean. Layers are parsed like pg.extract does,
+    #so a bare layer number selects datatype 0 only.
+    stripes = [s.bbox for s in O.references]
+    which = [_parse_layer(l) for l in which_layer]
+    if isinstance(device, Device):
+        to_stitch = index.query(stripes, layers=which).to_device()
+    else:
+        to_stitch = PolygonStore.concatenate([device.to_store(region=b, layers=which) for b in stripes]).to_device()
     S = pg.boolean(to_stitch, O, "and", layer=layer)
     S.name = "stitching"
     return S
 
 # Makes an hexagonal array of holes around an object
-#   around --> Device that the array is made around
+#   around --> Device or LazyLayout that the array is made around
 #   a --> lattice parameter
 #   size --> the size (x, y) of the array
 #   radius --> Radius of each grid point
@@ -184,28 +197,47 @@ def hole_array(around = None, a = 10, size = (500, 500), radius = 1, offset = 10
     if around is None:
         L.add_ref(R)
         return L
-    O = Device('overall')
-    dt = O.add_ref(R)
-    ar1 = O.add_ref(around)
-    ar2 = pg.outline(around, distance=offset, layer=layer)
-    
-    sub2 = pg.boolean(dt, ar2, 'not', layer = layer)
-    sub1 = pg.boolean(sub2, ar1, 'not', layer = layer)
+    #Dots clear of the outline are kept whole and dots well inside it are dropped. The mitered corners of the
+    #outline reach up to twice the offset, so only dots closer than that are cut by it.
+    centers = array([ref.origin for ref in R.references])
+    reach = 2*offset + radius
+    #A LazyLayout is loaded as far around the dots as the geometry looked at for them below
+    if not isinstance(around, Device):
+        margin = reach + offset
+        around = around.to_device(region=[[-size[0]/2 - margin, -size[1]/2 - margin],
+                                          [size[0]/2 + margin, size[1]/2 + margin]])
+    index = SpatialIndex(around)
+    distance = index.nearest(centers, reach)
+    edge = centers[(distance > offset - radius) & ~isinf(distance)]
+    sub1 = Device('boolean')
+    if len(edge):
+        O = Device('overall')
+        for c in edge:
+            O.add_ref(circle).move(destination = c)
+        near = index.query([[c - reach - offset, c + reach + offset] for c in edge]).to_device()
+        ar2 = pg.outline(near, distance=offset, layer=layer)
+        
+        sub2 = pg.boolean(O, ar2, 'not', layer = layer)
+        sub1 = pg.boolean(sub2, near, 'not', layer = layer)
+    for c in centers[isinf(distance)]:
+        sub1.add_ref(circle).move(destination = c)
     
     fin = L.add_ref(sub1)
     return L
 
 # Makes an hexagonal array of holes around an object
-#   avoid --> Device that the array is made around
+#   avoid --> Device or LazyLayout that the array is made around
 #   box --> Box in which the array is contained [x1, y1]
 #                                               [x2, y2]
 #   a --> lattice parameter
 #   radius --> Radius of each grid point
 #   offset --> distance between object and nearest dot
 #   layer --> Layer in which end result should  be
+#   exact --> keep every site farther than offset from the object, instead of the sites left free on a
+#             raster of the object and its outline. This admits some sites next to outline corners.
 #
 # Version 2.1
-def hex_Array(avoid = None, box = None, a = 10, radius = 1, offset = 10, layer = 1):
+def hex_Array(avoid = None, box = None, a = 10, radius = 1, offset = 10, layer = 1, exact = False):
     #Creating end product device and the dots used
     F = Device('Filler')
     cir = pg.circle(radius, layer = layer)
@@ -217,56 +249,40 @@ def hex_Array(avoid = None, box = None, a = 10, radius = 1, offset = 10, layer =
     #If the box is not defined, it becomes the boundary box for input device
     if box is None:
         box = avoid.bbox
+    box = array(box, dtype = float)
         
-    #Creating a temporary device for creating a raster array on
-    tempDev = Device('offset device')
-    purse = tempDev.add_ref(avoid)
-    liner = pg.outline(avoid, offset)
-    bag = tempDev.add_ref(liner)
-    
-    #Converting the objects into a list of polygons
-    shapes = tempDev.get_polygons()
-    
-    #Raster array box size
+    #Raster array box size, every about-th raster point is a lattice site
     dX = a/about
     dY = 2*disY/about
     
-    #Creating raster arrays, where false means the space is free
-    allowed1 = pg._rasterize_polygons(shapes,
-                                      box,
-                                      dX, dY)
-    allowed2 = pg._rasterize_polygons(shapes,
-                                      box + array([[a/2, disY], [0, 0]]),
-                                      dX, dY)
-    
-    #Sets of dots
-    dots1 = []
-    dots2 = []
-    
+    #Only the object near the box matters, mitered corners of its outline reach 2*offset
+    reach = 2*offset + max(dX, dY)
+    if avoid is not None and not isinstance(avoid, Device):
+        avoid = avoid.to_device(region=box + [[-reach, -reach], [reach, reach]])
+    index = SpatialIndex(avoid) if avoid is not None else None
+    if index is not None and not exact:
+        near = index.query([box + [[-reach, -reach], [reach, reach]]]).to_device()
+        tempDev = Device('offset device')
+        tempDev.add_ref(near)
+        tempDev.add_ref(pg.outline(near, offset))
+        shapes = tempDev.get_polygons()
     
     R = Device('Hole Array')
-    #Creating each hole
-    for row in range(size(allowed1, 0)):
-        if row % about == 0:
-            dots1.append([])
-            for col in range(size(allowed1, 1)):
-                if col % about == 0:
-                    dots1[int(row/about)].append([])
-                    if not allowed1[row][col]:
-                        dots1[int(row/about)][int(col/about)] = R.add_ref(cir)
-                        dots1[int(row/about)][int(col/about)].move(
-                            destination = (dX/2 + int(col/about)*a, dY/2 + int(row/about)*2*disY))
-        
-        
-    for row in range(size(allowed2, 0)):
-        if row % about == 0:
-            dots2.append([])
-            for col in range(size(allowed2, 1)):
-                if col % about == 0:
-                    dots2[int(row/about)].append([])
-                    if not allowed2[row][col]:
-                        dots2[int(row/about)][int(col/about)] = R.add_ref(cir)
-                        dots2[int(row/about)][int(col/about)].move(
-                            destination = (dX/2 + a/2 + int(col/about)*a, dY/2 + disY + int(row/about)*2*disY))
+    #Creating each hole, the second sublattice is shifted by half a period
+    for shift in ((0, 0), (a/2, disY)):
+        lower = box[0] + shift
+        cols = arange(int(ceil(box[1][0] - lower[0]) / dX))
+        rows = arange(int(ceil(box[1][1] - lower[1]) / dY))
+        cols, rows = cols[cols % about == 0], rows[rows % about == 0]
+        x, y = meshgrid(dX/2 + shift[0] + (cols/about).astype(int)*a, dY/2 + shift[1] + (rows/about).astype(int)*2*disY)
+        sites = stack([x.ravel(), y.ravel()], axis = 1)
+        if index is not None and exact:
+            sites = sites[isinf(index.nearest(sites + box[0], offset))]
+        elif index is not None:
+            #Sites on the raster of the object and its outline stay empty
+            allowed = pg._rasterize_polygons(shapes, array([lower, box[1]]), dX, dY)
+            sites = sites[~allowed[rows][:, cols].ravel()]
+        for site in sites:
+            R.add_ref(cir).move(destination = site)
 
     return R
\ No newline at end of file
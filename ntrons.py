@@ -2,12 +2,13 @@
 
 from phidl import Device, Layer
 import phidl.geometry as pg
+from .tapers import optimal_step
 
 def ntron(width = 10, choke = 5, gate = 1, negative = True, trench = 5, layer = 1):
     layer1 = Layer(layer, 1000)
     D = Device()
-    C = pg.optimal_step(start_width = width, end_width = choke, layer = layer1)
-    G = pg.optimal_step(start_width = width, end_width = gate, layer = layer1, symmetric = True, num_pts = 256)
+    C = optimal_step(start_width = width, end_width = choke, layer = layer1)
+    G = optimal_step(start_width = width, end_width = gate, layer = layer1, symmetric = True, num_pts = 256)
     T = pg.tee(size = [gate*3, choke], stub_size = [gate, gate], layer = layer1, taper_type = 'fillet')
 
     top = D.add_ref(C)
@@ -34,7 +35,7 @@ def viatron(width = 10, choke = 1, via = (0.8, 0.8), via_offset=0.5, gate_width
     )
 
     # Choke tapers
-    S1 = pg.optimal_step(start_width = choke, end_width = width, layer = layer_channel)
+    S1 = optimal_step(start_width = choke, end_width = width, layer = layer_channel)
     step_in = D.add_ref(S1)
     step_in.connect(1, centerpiece.ports['S'])
     step_out = D.add_ref(S1).mirror((0, 0), (1, 0))
@@ -52,7 +53,7 @@ def viatron(width = 10, choke = 1, via = (0.8, 0.8), via_offset=0.5, gate_width
 
     # Gate
     gate = D.add_ref(
-        pg.optimal_step(start_width = choke, end_width = gate_width,
+        optimal_step(start_width = choke, end_width = gate_width,
                         layer = layer_gate, symmetric = True, num_pts = 100)
     )
     gate.connect(1, toppiece.ports['W'])
@@ -4,6 +4,7 @@ from phidl import Device, Layer
 import numpy as np
 from numpy import sqrt, pi
 import phidl.geometry as pg
+from .tapers import optimal_step
 
 def bridge(width = 0.1, length = 10, trench = 0.25, connector_width = None, layer = None, negative = True):
     D = Device('Bridge')
@@ -316,10 +317,10 @@ def snap(width=0.1, pitch=0.2, size=(10,10), n=3, n_segs=3, turn_ratio=4, num_pt
 def ps_junction(width1 = 1, width2 = 1, widthj = 0.05, length = 1):
     D = Device()
     s1 = D.add_ref(
-        pg.optimal_step(end_width = width1, start_width = widthj, symmetric = True)
+        optimal_step(end_width = width1, start_width = widthj, symmetric = True)
     )
     s2 = D.add_ref(
-        pg.optimal_step(end_width = width2, start_width = widthj, symmetric = True)
+        optimal_step(end_width = width2, start_width = widthj, symmetric = True)
     )
     junction = D.add_ref(pg.straight((widthj, length)))
     s1.connect(1, junction.ports[1])
@@ -344,4 +345,185 @@ def charge_island():
     tap.rotate(-90)
     tap.movey(6)
 
-    return D
\ No newline at end of file
+    return D
+
+# Geometry-free metrics of the nanowire generators
+#
+# All metric functions take scalars or NumPy arrays (broadcast against each other) for their geometric
+# parameters and return a dict of arrays with:
+#   num_squares --> series number of squares of the wire
+#   length --> total wire length (wire area over width)
+#   area --> area of the wire polygons
+#   fill_factor --> wire area over the area of the bounding box of the meander
+#   inductance --> kinetic inductance in units of sheet_inductance (pH/sq gives pH)
+#   size --> (xsize, ysize) of the positive (negative=False) device
+#
+# The values follow the polygons the generators build, point by point, so they can be used to scan
+# parameters and only build the geometry of the chosen designs. Up to _TURN_EXACT different pitch/width
+# ratios are traced like the generators do. Larger sweeps interpolate the turns in a table of ratios,
+# which keeps num_squares and area within about 1e-3 relative of the polygons. Sizes are exact, except
+# for hairpins shorter than their turn, whose xsize can be off by one point spacing of the turn curve.
+
+_TURN_EXACT = 64
+_TURN_DENSITY = 300
+_turn_tables = {}
+
+def _hairpin_turn(ratio, num_pts, chunk=4096):
+    # Traces the optimal hairpin turn of half_hairpin/pg.optimal_hairpin for unit width and
+    # pitch = ratio, for many ratios at once. Returns the downsampled curve's last x and x extent, the
+    # height of its first point above the outer edge of the wire (rise) and its shoelace sum closed
+    # along that edge below the first point (area). These don't jump with the downsampling like the
+    # first point itself, so they can be interpolated between ratios.
+    out = {k: np.empty(len(ratio)) for k in ('xk', 'xmin', 'xmax', 'rise', 'area')}
+    for c in range(0, len(ratio), chunk):
+        r = ratio[c:c+chunk]
+        a = (r + 1) / 2
+        x = -r.copy()
+        y = -(r - 1) / 2
+        dl = 1 / (num_pts * 2)
+        xs, ys = [x], [y]
+        npts = np.ones(len(r), dtype=int)
+        active = y < 0
+        n = 0
+        while active.any() and n < 1e6:
+            w = sqrt(1 - np.exp(pi * (x + 1j * y) / a))
+            wx = np.real(w)
+            wy = np.imag(w)
+            wx = wx / sqrt(wx**2 + wy**2)
+            wy = wy / sqrt(wx**2 + wy**2)
+            x = np.where(active, x + wx * dl, x)
+            y = np.where(active, y + wy * dl, y)
+            xs.append(x)
+            ys.append(y)
+            npts += active
+            active = active & (y < 0)
+            n += 1
+        X, Y = np.array(xs), np.array(ys)
+        cols = np.arange(len(r))
+        last = npts - 1
+        Y[last, cols] = 0
+        ds = npts // num_pts
+        first = last % ds
+        idx = first + np.arange((last // ds).max() + 1)[:, None] * ds
+        valid = idx <= last
+        idx = np.where(valid, idx, last)
+        cx, cy = X[idx, cols], Y[idx, cols]
+        pair = valid[1:]
+        out['xk'][c:c+chunk] = X[last, cols]
+        out['xmin'][c:c+chunk] = np.where(valid, cx, np.inf).min(axis=0)
+        out['xmax'][c:c+chunk] = np.where(valid, cx, -np.inf).max(axis=0)
+        out['rise'][c:c+chunk] = cy[0] + a
+        out['area'][c:c+chunk] = (np.where(pair, cx[:-1] * cy[1:] - cx[1:] * cy[:-1], 0).sum(axis=0)
+                                  + cx[0] * (a - 1))
+    return out
+
+def _turns(ratio, num_pts):
+    # _hairpin_turn of the ratios, traced if there are few of them and otherwise interpolated in
+    # log(ratio) between the nodes of a table per num_pts. Nodes are traced as sweeps first need them.
+    if len(ratio) <= _TURN_EXACT:
+        return _hairpin_turn(ratio, num_pts)
+    table = _turn_tables.setdefault(num_pts, {})
+    k = np.log10(ratio) * _TURN_DENSITY
+    k0 = np.floor(k).astype(np.int64)
+    nodes = np.unique(np.r_[k0, k0 + 1])
+    missing = np.array([n for n in nodes if n not in table], dtype=np.int64)
+    if len(missing):
+        traced = _hairpin_turn(10.0 ** (missing / _TURN_DENSITY), num_pts)
+        for j, n in enumerate(missing):
+            table[n] = {q: v[j] for q, v in traced.items()}
+    i = np.searchsorted(nodes, k0)
+    f = k - k0
+    out = {}
+    for q in ('xk', 'xmin', 'xmax', 'rise', 'area'):
+        v = np.array([table[n][q] for n in nodes])
+        out[q] = v[i] * (1 - f) + v[i + 1] * f
+    return out
+
+def _half_hairpin(width, pitch, length, turn_ratio, num_pts):
+    # Area and x extent of the single polygon of half_hairpin (half of pg.optimal_hairpin)
+    ratio, inverse = np.unique(pitch / width, return_inverse=True)
+    turn = {k: v[inverse.reshape(np.shape(width))] * width for k, v in _turns(ratio, num_pts).items()}
+    turn['area'] *= width
+    a = (pitch + width) / 2
+    xr = turn['xk'] + turn_ratio * width
+    xm = np.maximum(turn['xmax'], xr)
+    x4 = xm - length
+    s = turn['area'] - 2*a*xr + x4*(width + turn['rise'])
+    return np.abs(s) / 2, np.minimum(turn['xmin'], x4), xm
+
+_optimal_steps = {}
+
+def _optimal_step(ratio, num_pts, anticrowding_factor):
+    # Area, length and squares of pg.optimal_step from unit width to ratio, cached per ratio
+    key = (ratio, num_pts, anticrowding_factor)
+    if key not in _optimal_steps:
+        S = pg.optimal_step(start_width=1, end_width=ratio, num_pts=num_pts, anticrowding_factor=anticrowding_factor)
+        x, y = S.polygons[0].polygons[0][:num_pts].T
+        squares = np.sum(np.abs(np.diff(x)) / ((y[:-1] + y[1:]) / 2)) if ratio != 1 else 1
+        _optimal_steps[key] = (S.area(), S.xsize, squares)
+    return _optimal_steps[key]
+
+def hairpin_metrics(width=0.1, pitch=0.2, length=10, turn_ratio=5, sheet_inductance=1):
+    width, pitch, length, turn_ratio = np.broadcast_arrays(*[np.asarray(v, dtype=float)
+                                                             for v in (width, pitch, length, turn_ratio)])
+    half, xmin, xmax = _half_hairpin(width, pitch, length, turn_ratio, 50)
+    area = 2 * half
+    squares = area / width**2
+    xsize, ysize = xmax - xmin, pitch + width
+    return {'num_squares': squares, 'length': area / width, 'area': area,
+            'fill_factor': area / (xsize * ysize), 'inductance': squares * sheet_inductance,
+            'size': (xsize, ysize)}
+
+def snspd_metrics(width=0.1, pitch=0.2, size=(10, 10), connector_width=None, turn_ratio=5, sheet_inductance=1):
+    width, pitch, xsize, ysize, turn_ratio = np.broadcast_arrays(
+        *[np.asarray(v, dtype=float) for v in (width, pitch, size[0], size[1], turn_ratio)])
+    num_meanders = np.ceil(ysize / pitch)
+    num_meanders += num_meanders % 2 == 0
+    half, xmin, xmax = _half_hairpin(width, pitch, xsize / 2, turn_ratio, 20)
+    area = (num_meanders - 1) * 2 * half + xsize * width
+    length = area / width
+    squares = area / width**2
+    ysize = (num_meanders - 1) * pitch + width
+    fill_factor = area / (xsize * ysize)
+    if connector_width is not None:
+        connector_width = np.broadcast_to(np.asarray(connector_width, dtype=float), width.shape)
+        ratio, inverse = np.unique(connector_width / width, return_inverse=True)
+        steps = np.array([_optimal_step(r, 100, 2) for r in ratio])[inverse.reshape(width.shape)]
+        area = area + 2 * steps[..., 0] * width**2
+        length = length + 2 * steps[..., 1] * width
+        squares = squares + 2 * steps[..., 2]
+        xsize = xsize + 2 * steps[..., 1] * width
+        ysize = np.maximum(ysize, connector_width)
+    return {'num_squares': squares, 'length': length, 'area': area, 'fill_factor': fill_factor,
+            'inductance': squares * sheet_inductance, 'size': (xsize, ysize)}
+
+def snap_metrics(width=0.1, pitch=0.2, size=(10, 10), n=3, n_segs=3, turn_ratio=4, num_pts=50, sheet_inductance=1):
+    width, pitch, xsize, ysize, n, n_segs, turn_ratio = np.broadcast_arrays(
+        *[np.asarray(v, dtype=float) for v in (width, pitch, size[0], size[1], n, n_segs, turn_ratio)])
+    seg_length = xsize / n_segs
+    a = (pitch + width) / 2
+    half, _, _ = _half_hairpin(width, pitch, seg_length / 2, turn_ratio, num_pts)
+    mid = 2 * half - seg_length / 2 * width
+
+    def comb(k):
+        return 2 * half + (k - 2) * mid, 2 * a + (k - 2) * (2 * a - width)
+
+    comb_n, h_n = comb(n)
+    comb_2n, h_2n = comb(2 * n)
+    segment = 2 * comb_n
+    lines = np.maximum(n_segs - 2, 1)
+    stops = np.maximum(n_segs - 1, 1)
+    turn = comb_2n + width * n * h_2n + 2 * comb_n
+    unit = 2 * lines * segment + 2 * turn
+
+    # snap() stacks units, each 2*(h_2n - h_n) higher, until the height reaches size[1]
+    rise = 2 * (h_2n - h_n)
+    h0 = 2 * h_2n - h_n
+    units = 1 + np.maximum(np.ceil((ysize - h0) / rise), 0)
+    area = units * unit + segment + stops * segment + 2 * width * n * h_n
+    squares = area / (n * width)**2
+    xsize = (np.maximum(stops, lines + 1) + 1) * seg_length + 2 * width * n
+    ysize = h0 + (units - 1) * rise
+    return {'num_squares': squares, 'length': area / width, 'area': area,
+            'fill_factor': area / (xsize * ysize), 'inductance': squares * sheet_inductance,
+            'size': (xsize, ysize)}
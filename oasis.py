@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+import zlib
+import struct
+import numpy as np
+
+_MAGIC = b'%SEMI-OASIS\r\n'
+
+def _uint(v):
+    v = int(v)
+    out = bytearray()
+    while v > 0x7f:
+        out.append((v & 0x7f) | 0x80)
+        v >>= 7
+    out.append(v)
+    return bytes(out)
+
+def _sint(v):
+    v = int(v)
+    return _uint(((-v) << 1) | 1 if v < 0 else v << 1)
+
+def _string(s):
+    s = s.encode('ascii')
+    return _uint(len(s)) + s
+
+def _name(s):
+    # OASIS n-string: a non-empty string of printable ASCII characters without spaces
+    return len(s) > 0 and all('!' <= ch <= '~' for ch in s)
+
+def _real(v):
+    if float(v).is_integer():
+        return _uint(0 if v >= 0 else 1) + _uint(abs(v))
+    return b'\x07' + struct.pack('<d', v)
+
+def _gdelta(dx, dy):
+    return _uint((abs(int(dx)) << 2) | ((dx < 0) << 1) | 1) + _sint(dy)
+
+def _runs(v):
+    # Splits sorted values into maximal runs of constant step as (first index, count, step)
+    n = len(v)
+    d = np.diff(v)
+    if n == 1 or np.all(d == d[0]):
+        return [(0, n, d[0] if n > 1 else 0)]
+    runs = []
+    i = 0
+    while i < n:
+        if i == n - 1:
+            runs.append((i, 1, 0))
+            break
+        step, j = d[i], i + 1
+        while j < n - 1 and d[j] == step:
+            j += 1
+        runs.append((i, j - i + 1, step))
+        i = j + 1
+    return runs
+
+# Decomposes a set of integer positions into regular repetitions
+#   xy --> (n, 2) array of positions on the database grid
+#
+# Positions are split into rows of constant pitch, rows with the same start, pitch and count are stacked
+# into columns of constant pitch, and whatever is left over is written as one arbitrary repetition list.
+# Returns a list of (position, repetition) where repetition is None for a single element.
+def _repetitions(xy):
+    if len(xy) == 1:
+        return [(xy[0], None)]
+    xy = xy[np.lexsort((xy[:, 0], xy[:, 1]))]
+    dup = np.zeros(len(xy), dtype=bool)
+    dup[1:] = np.all(xy[1:] == xy[:-1], axis=1)
+    loose = [xy[dup]]
+    xy = xy[~dup]
+
+    columns = {}
+    for row in np.split(xy, np.flatnonzero(np.diff(xy[:, 1])) + 1):
+        for i, n, dx in _runs(row[:, 0]):
+            columns.setdefault((row[i, 0], dx, n), []).append(row[0, 1])
+
+    out = []
+    for (x, dx, n), ys in columns.items():
+        ys = np.array(ys)
+        for i, m, dy in _runs(ys):
+            y = ys[i]
+            if n > 1 and m > 1:
+                out.append(((x, y), ('matrix', n, m, dx, dy)))
+            elif n > 1:
+                out.append(((x, y), ('row', n, dx)))
+            elif m > 1:
+                out.append(((x, y), ('column', m, dy)))
+            else:
+                loose.append(np.array([[x, y]]))
+
+    loose = np.concatenate(loose)
+    if len(loose) == 1:
+        out.append((loose[0], None))
+    elif len(loose) > 1:
+        out.append((loose[0], ('list', np.diff(loose, axis=0))))
+    return out
+
+def _repetition(rep):
+    kind = rep[0]
+    if kind == 'matrix':
+        _, n, m, dx, dy = rep
+        return _uint(1) + _uint(n - 2) + _uint(m - 2) + _uint(dx) + _uint(dy)
+    if kind == 'row':
+        return _uint(2) + _uint(rep[1] - 2) + _uint(rep[2])
+    if kind == 'column':
+        return _uint(3) + _uint(rep[1] - 2) + _uint(rep[2])
+    if kind == 'lattice':
+        _, n, m, (ndx, ndy), (mdx, mdy) = rep
+        return _uint(8) + _uint(n - 2) + _uint(m - 2) + _gdelta(ndx, ndy) + _gdelta(mdx, mdy)
+    if kind == 'vector':
+        _, n, (dx, dy) = rep
+        return _uint(9) + _uint(n - 2) + _gdelta(dx, dy)
+    deltas = rep[1]
+    return _uint(10) + _uint(len(deltas) - 1) + b''.join(_gdelta(dx, dy) for dx, dy in deltas)
+
+def _polygon(layer, datatype, points, xy, rep):
+    out = bytearray(_uint(21))
+    out.append(0x3b | (0x04 if rep else 0))
+    out += _uint(layer) + _uint(datatype)
+    deltas = np.diff(points, axis=0)
+    out += _uint(4) + _uint(len(deltas))
+    out += b''.join(_gdelta(dx, dy) for dx, dy in deltas)
+    out += _sint(xy[0]) + _sint(xy[1])
+    if rep:
+        out += _repetition(rep)
+    return bytes(out)
+
+def _rectangle(layer, datatype, w, h, xy, rep):
+    info = 0x7b | (0x04 if rep else 0)
+    out = _uint(20) + bytes([info]) + _uint(layer) + _uint(datatype) + _uint(w) + _uint(h)
+    out += _sint(xy[0]) + _sint(xy[1])
+    if rep:
+        out += _repetition(rep)
+    return out
+
+def _placement(refnum, rotation, magnification, x_reflection, xy, rep):
+    quadrant = rotation / 90
+    if magnification == 1 and quadrant.is_integer():
+        info = 0xf0 | (int(quadrant) % 4) << 1 | x_reflection | (0x08 if rep else 0)
+        out = _uint(17) + bytes([info]) + _uint(refnum)
+    else:
+        info = 0xf6 | x_reflection | (0x08 if rep else 0)
+        out = _uint(18) + bytes([info]) + _uint(refnum) + _real(magnification) + _real(rotation)
+    out += _sint(xy[0]) + _sint(xy[1])
+    if rep:
+        out += _repetition(rep)
+    return out
+
+def _text(text, layer, texttype, xy):
+    return _uint(19) + bytes([0x5b]) + _string(text) + _uint(layer) + _uint(texttype) + _sint(xy[0]) + _sint(xy[1])
+
+def _cblock(data):
+    c = zlib.compressobj(level=6, wbits=-15)
+    packed = c.compress(data) + c.flush()
+    return _uint(34) + _uint(0) + _uint(len(data)) + _uint(len(packed)) + packed
+
+def _cell_elements(cell, refnums, scale, repetitions):
+    out = []
+
+    shapes = {}
+    for polygonset in cell.polygons:
+        for points, layer, datatype in zip(polygonset.polygons, polygonset.layers, polygonset.datatypes):
+            points = np.round(np.asarray(points) * scale).astype(np.int64)
+            if len(points) > 3 and np.all(points[0] == points[-1]):
+                points = points[:-1]
+            if len(points) < 3:
+                continue
+            xs, ys = np.unique(points[:, 0]), np.unique(points[:, 1])
+            if len(points) == 4 and len(xs) == 2 and len(ys) == 2 and \
+                    np.all((points[:, 0] == points[[1, 2, 3, 0], 0]) != (points[:, 1] == points[[1, 2, 3, 0], 1])):
+                key = ('rect', layer, datatype, xs[1] - xs[0], ys[1] - ys[0])
+                shape, xy = None, (xs[0], ys[0])
+            else:
+                shape = points - points[0]
+                key = ('poly', layer, datatype, len(shape), shape.tobytes())
+                xy = points[0]
+            shapes.setdefault(key, ([], shape))[0].append(xy)
+    for key, (positions, shape) in shapes.items():
+        positions = np.array(positions, dtype=np.int64)
+        placed = _repetitions(positions) if repetitions else [(xy, None) for xy in positions]
+        for xy, rep in placed:
+            if key[0] == 'rect':
+                out.append(_rectangle(key[1], key[2], key[3], key[4], xy, rep))
+            else:
+                out.append(_polygon(key[1], key[2], shape, xy, rep))
+
+    placements = {}
+    for ref in cell.references:
+        rotation = float(ref.rotation or 0) % 360
+        magnification = float(ref.magnification or 1)
+        x_reflection = int(bool(ref.x_reflection))
+        origin = np.asarray(ref.origin) * scale
+        key = (refnums[ref.parent.uid], rotation, magnification, x_reflection)
+        columns, rows = getattr(ref, 'columns', 1), getattr(ref, 'rows', 1)
+        if columns * rows == 1:
+            placements.setdefault(key, []).append(np.round(origin).astype(np.int64))
+            continue
+        # Arrays are lattices spanned by the transformed spacing vectors, off-grid ones are expanded
+        ca, sa = np.cos(rotation*np.pi/180), np.sin(rotation*np.pi/180)
+        sx, sy = ref.spacing[0], -ref.spacing[1] if x_reflection else ref.spacing[1]
+        cv = np.array([sx*ca, sx*sa]) * scale
+        rv = np.array([-sy*sa, sy*ca]) * scale
+        if not np.allclose(np.r_[cv, rv], np.round(np.r_[cv, rv]), rtol=0, atol=1e-6):
+            i, j = np.meshgrid(np.arange(columns), np.arange(rows))
+            positions = origin + np.outer(i.ravel(), cv) + np.outer(j.ravel(), rv)
+            placements.setdefault(key, []).extend(np.round(positions).astype(np.int64))
+            continue
+        origin = np.round(origin).astype(np.int64)
+        cv, rv = np.round(cv).astype(np.int64), np.round(rv).astype(np.int64)
+        if columns > 1 and rows > 1:
+            if cv[1] == 0 and rv[0] == 0 and cv[0] > 0 and rv[1] > 0:
+                rep = ('matrix', columns, rows, cv[0], rv[1])
+            else:
+                rep = ('lattice', columns, rows, cv, rv)
+        else:
+            rep = ('vector', columns * rows, cv if columns > 1 else rv)
+        out.append(_placement(*key, origin, rep))
+    for key, positions in placements.items():
+        positions = np.array(positions, dtype=np.int64)
+        placed = _repetitions(positions) if repetitions else [(xy, None) for xy in positions]
+        for xy, rep in placed:
+            out.append(_placement(*key, xy, rep))
+
+    for label in cell.labels:
+        xy = np.round(np.asarray(label.position) * scale).astype(np.int64)
+        out.append(_text(str(label.text), label.layer, label.texttype, xy))
+    return b''.join(out)
+
+# Writes a Device hierarchy to an OASIS file
+#   device --> Device to be written, becomes the top cell
+#   filename --> output path, '.oas' is appended if missing
+#   unit --> user unit in meters (phidl coordinates are in microns)
+#   precision --> database grid in meters
+#   cellname --> name of the top cell
+#   compress --> wraps the cell contents in deflate-compressed CBLOCKs
+#   repetitions --> encodes regular grids, rows and repeated placements of identical
+#                   references and polygons as OASIS repetitions
+#
+# Cell names are made unique the same way phidl's write_gds does, without renaming the Devices. They have
+# to be printable ASCII without spaces, as OASIS requires.
+def write_oasis(device, filename, unit=1e-6, precision=1e-9, cellname='toplevel', compress=True,
+                repetitions=True):
+    if not filename.endswith('.oas'):
+        filename += '.oas'
+    scale = unit/precision
+    cells = sorted([device] + list(device.get_dependencies(recursive=True)), key=lambda c: c.uid)
+    for name in [cellname] + [c.name for c in cells if c is not device]:
+        if not _name(name):
+            raise ValueError('[DeviceLib] write_oasis() Cell name %r is not valid in OASIS, names have to be '
+                             'printable ASCII characters without spaces' % name)
+    names = {}
+    used_names = {cellname}
+    n = 1
+    for c in cells:
+        if c is device:
+            continue
+        name = c.name
+        while name in used_names:
+            n += 1
+            name = c.name + ('%0.3i' % n)
+        used_names.add(name)
+        names[c.uid] = name
+    names[device.uid] = cellname
+    refnums = {c.uid: i for i, c in enumerate(cells)}
+
+    with open(filename, 'wb') as f:
+        f.write(_MAGIC)
+        f.write(_uint(1) + _string('1.0') + _real(round(1e-6/precision, 12)) + _uint(0) + _uint(0)*12)
+        table = b''.join(_uint(3) + _string(names[c.uid]) for c in cells)
+        f.write(_cblock(table) if compress else table)
+        for c in cells:
+            f.write(_uint(13) + _uint(refnums[c.uid]))
+            body = _cell_elements(c, refnums, scale, repetitions)
+            f.write(_cblock(body) if compress and body else body)
+        padding = 254 - len(_uint(252))
+        f.write(_uint(2) + _uint(padding) + bytes(padding) + _uint(0))
+    return filename
@@ -3,6 +3,7 @@
 import numpy as np
 from phidl import Device, Layer
 import phidl.geometry as pg
+from .tapers import optimal_step
 import phidl.path as pp
 
 def launchpad(size = (350, 350), wire_width = 50, negative = True, trench = 10, layer = None, metal_layer = None,
@@ -77,7 +78,7 @@ def fan(size = (100, 50), wire_width = 50, trench = 10, layer = None, optimize=N
     D.add_port(name = 'out', midpoint = [size[1]/2, 0], width = size[0]+wire_width, orientation = 0)
     D.add_port(name = '_in', midpoint = [0, 0], width = wire_width, orientation = 180)
     if optimize:
-        ST = pg.optimal_step(start_width=optimize, end_width=wire_width, symmetric=True)
+        ST = optimal_step(start_width=optimize, end_width=wire_width, symmetric=True)
         ST = pg.outline(ST, distance=trench, open_ports=2*trench, layer=layer)
         step = D << ST
         step.connect(2, D.ports['_in'])
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import gdspy
+from scipy.special import erf
+from concurrent.futures import ThreadPoolExecutor
+from phidl import Device
+from .polystore import PolygonStore
+from .spatial import SpatialIndex
+
+def _fracture(S, size, origin, precision=1e-3):
+    # Cuts the polygons larger than size along the lines of a size grid starting at origin. Rectangles are
+    # cut into their grid cells directly, other polygons are sliced by gdspy at the lines crossing them.
+    bboxes = S.bboxes()
+    big = np.any(bboxes[:, 1] - bboxes[:, 0] > size, axis=1)
+    if not big.any():
+        return S
+    rect = big & (S.counts == 4) & np.isclose(S.areas(), np.prod(bboxes[:, 1] - bboxes[:, 0], axis=1))
+
+    first = np.floor((bboxes[:, 0] - origin) / size).astype(np.int64) + 1
+    last = np.ceil((bboxes[:, 1] - origin) / size).astype(np.int64) - 1
+    cuts = lambda n, axis: list(origin[axis] + size * np.arange(first[n, axis], last[n, axis] + 1))
+    pieces = []
+    for n in np.flatnonzero(big & ~rect):
+        parts = [S[n]]
+        for axis in (0, 1):
+            if last[n, axis] >= first[n, axis]:
+                parts = [p for s in gdspy.slice(parts, cuts(n, axis), axis, precision=precision) if s is not None
+                         for p in s.polygons]
+        pieces += parts
+
+    # Grid cells of the rectangles, clipped to them
+    r = np.flatnonzero(rect)
+    ni, nj = last[r, 0] - first[r, 0] + 2, last[r, 1] - first[r, 1] + 2
+    box = np.repeat(r, ni * nj)
+    k = np.arange(len(box)) - np.repeat(np.cumsum(ni * nj) - ni * nj, ni * nj)
+    cell = np.stack([first[box, 0] - 1 + k % np.repeat(ni, ni * nj), first[box, 1] - 1 + k // np.repeat(ni, ni * nj)], axis=1)
+    lo = np.maximum(origin + size * cell, bboxes[box, 0])
+    hi = np.minimum(origin + size * (cell + 1), bboxes[box, 1])
+    corners = np.stack([lo, np.c_[hi[:, 0], lo[:, 1]], hi, np.c_[lo[:, 0], hi[:, 1]]], axis=1)
+    cells = PolygonStore(corners.reshape(-1, 2), 4 * np.arange(len(box) + 1), S.layers[box], S.datatypes[box])
+    return PolygonStore.concatenate([S.take(~big), cells,
+                                     PolygonStore.from_polygons(pieces, S.layers[0], S.datatypes[0])])
+
+def _centroids(S):
+    # Area centroids of the polygons, the vertex mean for degenerate ones
+    nxt = np.arange(1, len(S.vertices) + 1)
+    nxt[S.offsets[1:] - 1] = S.offsets[:-1]
+    x, y = S.vertices.T
+    cross = x*y[nxt] - x[nxt]*y
+    starts = S.offsets[:-1]
+    a = np.add.reduceat(cross, starts)
+    cx = np.add.reduceat((x + x[nxt]) * cross, starts)
+    cy = np.add.reduceat((y + y[nxt]) * cross, starts)
+    mean = np.stack([np.add.reduceat(S.vertices[:, k], starts) for k in (0, 1)], axis=1) / S.counts[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c = np.stack([cx, cy], axis=1) / (3 * a[:, None])
+    return np.where(np.abs(a)[:, None] > 1e-12, c, mean)
+
+def _widths(S):
+    # Width of the polygons seen as strips, twice the area over the perimeter
+    d = np.diff(np.r_[S.vertices, S.vertices[:1]], axis=0)
+    d[S.offsets[1:] - 1] = S.vertices[S.offsets[:-1]] - S.vertices[S.offsets[1:] - 1]
+    perimeter = np.add.reduceat(np.hypot(*d.T), S.offsets[:-1])
+    return 2 * S.areas() / np.maximum(perimeter, 1e-300)
+
+def _coverage(target, polygons, tx, ty, ps):
+    # Adds the area of every pixel covered by polygons to target, whose pixel (0, 0) is pixel (tx, ty) of the
+    # layout grid. Edges are cut at the pixel lines, each piece adds its signed height to the pixels right
+    # of it, shared with its own pixel by the fraction of that pixel right of the piece. A cumulative sum
+    # along the rows then gives the covered area, exact for every polygon size.
+    h, w = target.shape
+    counts = np.array([len(p) for p in polygons])
+    offsets = np.r_[0, np.cumsum(counts)]
+    pts = np.concatenate(polygons) / ps - (tx, ty)
+    nxt = np.arange(1, len(pts) + 1)
+    nxt[offsets[1:] - 1] = offsets[:-1]
+    # All polygons count positive, whatever their orientation
+    x, y = pts.T
+    sign = np.sign(np.add.reduceat(x*y[nxt] - x[nxt]*y, offsets[:-1]))
+    a, d = pts, pts[nxt] - pts
+    dy = -d[:, 1] * np.repeat(sign, counts)
+
+    # Parameters t along every edge where it crosses a pixel line inside the target, and its ends
+    cuts = [np.zeros(len(a)), np.ones(len(a))]
+    edges = [np.arange(len(a))] * 2
+    for k, size in ((0, w), (1, h)):
+        lo = np.clip(np.floor(np.minimum(a[:, k], a[:, k] + d[:, k])) + 1, 0, size + 1)
+        hi = np.clip(np.ceil(np.maximum(a[:, k], a[:, k] + d[:, k])) - 1, -1, size)
+        n = np.maximum(hi - lo + 1, 0).astype(np.int64)
+        e = np.repeat(np.arange(len(a)), n)
+        line = np.repeat(lo, n) + np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        cuts.append((line - a[e, k]) / d[e, k])
+        edges.append(e)
+    e, t = np.concatenate(edges), np.concatenate(cuts)
+    order = np.lexsort((t, e))
+    e, t = e[order], t[order]
+    piece = np.flatnonzero(e[1:] == e[:-1])
+    e, t0, t1 = e[piece], t[piece], t[piece + 1]
+    p0, p1 = a[e] + t0[:, None] * d[e], a[e] + t1[:, None] * d[e]
+    mid = (p0 + p1) / 2
+    height = (t1 - t0) * dy[e]
+    row = np.floor(mid[:, 1]).astype(np.int64)
+    col = np.floor(mid[:, 0]).astype(np.int64)
+    keep = (row >= 0) & (row < h) & (col < w) & (height != 0)
+    row, col, mid, height = row[keep], col[keep], mid[keep], height[keep]
+    # Pieces left of the target cover whole rows of it
+    frac = np.where(col < 0, 0, mid[:, 0] - col)
+    col = np.maximum(col, 0)
+    acc = np.zeros((h, w + 1))
+    np.add.at(acc, (row, col), height * (1 - frac))
+    np.add.at(acc, (row, col + 1), height * frac)
+    target += acc.cumsum(1)[:, :w]
+
+def _backscatter(polygons, points, tx, ty, size, ps, sigma):
+    # Backscattered density at points, from the polygons rasterized by area on a size x size tile whose
+    # pixel (0, 0) is pixel (tx, ty) of the layout grid and blurred with the Gaussian of width sigma pixels
+    C = np.zeros((size, size))
+    _coverage(C, polygons, tx, ty, ps)
+    return _sample(_blur(np.minimum(C, 1), sigma), points, tx, ty, ps)
+
+def _blur(C, sigma):
+    # Convolution of C with the normalized Gaussian exp(-r^2/sigma^2)/(pi*sigma^2), sigma in pixels
+    ky = np.fft.fftfreq(C.shape[0])[:, None]
+    kx = np.fft.rfftfreq(C.shape[1])[None, :]
+    return np.fft.irfft2(np.fft.rfft2(C) * np.exp(-(np.pi * sigma)**2 * (kx**2 + ky**2)), s=C.shape)
+
+def _sample(image, points, tx, ty, ps):
+    # Bilinear samples of image at points, pixel (0, 0) of image being pixel (tx, ty) of the layout grid
+    h, w = image.shape
+    u = points / ps - (tx, ty) - 0.5
+    c0 = np.clip(np.floor(u).astype(int), 0, (w - 2, h - 2))
+    f = np.clip(u - c0, 0, 1)
+    (x0, y0), (fx, fy) = c0.T, f.T
+    return ((image[y0, x0] * (1 - fx) + image[y0, x0 + 1] * fx) * (1 - fy)
+            + (image[y0 + 1, x0] * (1 - fx) + image[y0 + 1, x0 + 1] * fx) * fy)
+
+# Proximity effect correction of an e-beam layer, every polygon gets one of a set of dose classes
+#   D --> Device or LazyLayout to correct, it is not changed
+#   layer --> layer to correct, int for all datatypes or (layer, datatype)
+#   WF --> write field size, the tiles are the write fields of misc.stiches
+#   WA --> Device whose bounding box sets the write field grid, the bounding box of D if None
+#   alpha, beta --> forward and backscattering ranges of the double Gaussian point spread function
+#   eta --> ratio of the backscattered to the forward deposited energy
+#   pixel_size --> raster pixel, beta/5 if None
+#   margin --> overlap of the tiles, 3*beta if None
+#   classes --> number of dose classes, the class of a polygon is its datatype in the output
+#   dose_range --> (smallest, largest) dose, relative to the dose that clears large areas
+#   fracture --> polygons larger than this are cut on a grid aligned to the write fields, so that they
+#                can get different doses at their edges and middle. None keeps the polygons whole.
+#   workers --> number of threads for the tiles
+#
+# Each write field is rasterized with its margin, every pixel holding the fraction of it that is covered,
+# and blurred with the backscattering Gaussian by FFT, which gives the backscattered density B around
+# every polygon. The forward scattered exposure at the
+# edge of a strip of width w is erf(w/alpha)/2, it is found from the width of the polygon itself since
+# alpha is usually far below the pixel. With F = erf(w/alpha) the dose (1+eta)/(F + 2*eta*B) brings the
+# edges of every polygon to half the exposure of a large area, which is the clearing threshold at unit
+# dose.
+# Returns a flat Device with the polygons on (layer, class), the doses of the classes are in its info.
+def pec(D, layer, WF=100, WA=None, alpha=0.05, beta=10, eta=0.5, pixel_size=None, margin=None, classes=16,
+        dose_range=(0.5, 2.5), fracture=None, workers=None):
+    ps = beta / 5 if pixel_size is None else pixel_size
+    margin = 3 * beta if margin is None else margin
+    m = int(np.ceil(margin / ps))
+    if isinstance(D, Device):
+        S = PolygonStore.from_device(D, layers=[layer])
+    else:
+        S = D.to_store(layers=[layer])
+    doses = np.linspace(dose_range[0], dose_range[1], classes)
+    if len(S) == 0:
+        out = Device('pec')
+        out.info['doses'] = {k: float(d) for k, d in enumerate(doses)}
+        return out
+    #The write fields start at the corner of the whole layout, like those of misc.stiches
+    if WA:
+        origin = np.asarray(WA.bbox[0], dtype=float)
+    else:
+        origin = np.asarray((SpatialIndex(D).bbox if isinstance(D, Device) else D.bbox)[0], dtype=float)
+    if fracture is not None:
+        S = _fracture(S, fracture, origin)
+
+    # Polygons belong to the write field of their centroid, and take part in every tile they touch
+    centers = _centroids(S)
+    owner = np.floor((centers - origin) / WF).astype(np.int64)
+    bboxes = S.bboxes()
+    i0, j0 = np.floor((bboxes[:, 0] - margin - origin) / WF).astype(np.int64).T
+    i1, j1 = np.floor((bboxes[:, 1] + margin - origin) / WF).astype(np.int64).T
+    ni, nj = i1 - i0 + 1, j1 - j0 + 1
+    poly = np.repeat(np.arange(len(S)), ni * nj)
+    k = np.arange(len(poly)) - np.repeat(np.cumsum(ni * nj) - ni * nj, ni * nj)
+    tiles, inverse = np.unique(np.stack([i0[poly] + k % ni[poly], j0[poly] + k // ni[poly]], axis=1), axis=0,
+                               return_inverse=True)
+    order = np.argsort(inverse.ravel(), kind='stable')
+    bounds = np.r_[0, np.cumsum(np.bincount(inverse.ravel(), minlength=len(tiles)))]
+    tile_of = {tuple(t): n for n, t in enumerate(tiles)}
+    owned = np.array([tile_of[tuple(o)] for o in owner])
+    own_order = np.argsort(owned, kind='stable')
+    own_bounds = np.r_[0, np.cumsum(np.bincount(owned, minlength=len(tiles)))]
+
+    B = np.zeros(len(S))
+    def correct(n):
+        mine = own_order[own_bounds[n]:own_bounds[n + 1]]
+        if len(mine) == 0:
+            return
+        members = poly[order[bounds[n]:bounds[n + 1]]]
+        tx = int(np.floor((origin[0] + tiles[n][0] * WF) / ps)) - m
+        ty = int(np.floor((origin[1] + tiles[n][1] * WF) / ps)) - m
+        size = int(np.ceil(WF / ps)) + 2 * m + 1
+        B[mine] = _backscatter([S[p] for p in members], centers[mine], tx, ty, size, ps, beta / ps)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(correct, range(len(tiles))))
+
+    F = erf(_widths(S) / alpha)
+    dose = (1 + eta) / (F + 2 * eta * np.clip(B, 0, 1))
+    step = (doses[-1] - doses[0]) / max(classes - 1, 1)
+    S.datatypes = np.clip(np.round((dose - doses[0]) / max(step, 1e-300)), 0, classes - 1).astype(S.datatypes.dtype)
+    S.layers = np.full(len(S), layer if np.size(layer) == 1 else layer[0], dtype=S.layers.dtype)
+    out = S.to_device('pec')
+    out.info['doses'] = {k: float(d) for k, d in enumerate(doses)}
+    return out
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+import struct
+import numpy as np
+import gdspy
+from gdspy.gdsiiformat import _eight_byte_real
+from phidl import Device
+from phidl.device_layout import _rotate_points, _reflect_points
+
+def _origins(ref):
+    # Origins of all instances of a reference, the lattice vectors of arrays follow its rotation and reflection
+    rotation = ref.rotation or 0
+    columns, rows = getattr(ref, 'columns', 1), getattr(ref, 'rows', 1)
+    if columns * rows == 1:
+        return np.array([ref.origin], dtype=float)
+    ca, sa = np.cos(np.radians(rotation)), np.sin(np.radians(rotation))
+    sx, sy = ref.spacing[0], -ref.spacing[1] if ref.x_reflection else ref.spacing[1]
+    i, j = np.meshgrid(np.arange(columns), np.arange(rows))
+    return np.outer(i.ravel(), (sx*ca, sx*sa)) + np.outer(j.ravel(), (-sy*sa, sy*ca)) + ref.origin
+
+# Flat polygon container backed by contiguous arrays
+#   vertices --> (N, 2) float array with the vertices of all polygons, one after another
+#   offsets --> (n+1,) int array, polygon i is vertices[offsets[i]:offsets[i+1]]
+#   layers, datatypes --> (n,) int arrays with the layer of each polygon
+#
+# Geometry operations act on the whole vertex buffer at once and polygons are handed out as views,
+# so a cell with 1e5 small polygons costs a few arrays instead of 1e5 gdspy objects.
+class PolygonStore(object):
+
+    def __init__(self, vertices=None, offsets=None, layers=None, datatypes=None):
+        self.vertices = np.zeros((0, 2)) if vertices is None else np.asarray(vertices, dtype=float)
+        self.offsets = np.zeros(1, dtype=np.int64) if offsets is None else np.asarray(offsets, dtype=np.int64)
+        n = len(self.offsets) - 1
+        self.layers = np.broadcast_to(np.asarray(0 if layers is None else layers, dtype=np.int32), (n,)).copy()
+        self.datatypes = np.broadcast_to(np.asarray(0 if datatypes is None else datatypes, dtype=np.int32), (n,)).copy()
+
+    @classmethod
+    def from_polygons(cls, polygons, layers=0, datatypes=0):
+        polygons = [np.asarray(p, dtype=float) for p in polygons]
+        if not polygons:
+            return cls()
+        offsets = np.zeros(len(polygons) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(p) for p in polygons])
+        return cls(np.concatenate(polygons), offsets, layers, datatypes)
+
+    # Returns a store with the polygons of a cell itself, without its references
+    @classmethod
+    def from_cell(cls, cell):
+        return cls.from_elements(cell.polygons, getattr(cell, 'paths', []))
+
+    # Returns a store with the polygons of a list of polygon sets and paths. Paths, which only come with
+    # imported GDS files, are converted to polygons.
+    @classmethod
+    def from_elements(cls, polygonsets, paths=()):
+        polygons, layers, datatypes = [], [], []
+        for polygonset in polygonsets:
+            polygons += polygonset.polygons
+            layers += polygonset.layers
+            datatypes += polygonset.datatypes
+        for path in paths:
+            for (l, d), p in path.get_polygons(by_spec=True).items():
+                polygons += p
+                layers += [l] * len(p)
+                datatypes += [d] * len(p)
+        return cls.from_polygons(polygons, layers, datatypes)
+
+    # Flattens a Device into a store. Each unique cell is converted once, references and arrays are
+    # placed by transforming the child's vertex buffer as a whole.
+    #   cache --> dict of converted cells by uid, can be shared between calls
+    @classmethod
+    def from_device(cls, device, layers=None, cache=None):
+        cache = {} if cache is None else cache
+        if device.uid not in cache:
+            cache[device.uid] = cls.concatenate([cls.from_cell(device), cls.from_references(device.references, cache=cache)])
+        S = cache[device.uid]
+        return S if layers is None else S.extract(layers)
+
+    # Flattens a list of references. References sharing a cell and orientation are transformed once
+    # and tiled to all their origins.
+    @classmethod
+    def from_references(cls, references, layers=None, cache=None):
+        cache = {} if cache is None else cache
+        groups = {}
+        for ref in references:
+            key = (ref.parent.uid, ref.rotation or 0, ref.magnification or 1, bool(ref.x_reflection))
+            groups.setdefault(key, (ref.parent, []))[1].append(_origins(ref))
+        parts = []
+        for (_, rotation, magnification, x_reflection), (parent, origins) in groups.items():
+            S = cls.from_device(parent, cache=cache)
+            parts.append(S.placed(np.concatenate(origins), rotation, magnification, x_reflection))
+        S = cls.concatenate(parts)
+        return S if layers is None else S.extract(layers)
+
+    @classmethod
+    def concatenate(cls, stores):
+        stores = [s for s in stores if len(s)]
+        if not stores:
+            return cls()
+        shifts = np.cumsum([0] + [len(s.vertices) for s in stores[:-1]])
+        offsets = np.concatenate([[0]] + [s.offsets[1:] + k for s, k in zip(stores, shifts)])
+        return cls(np.concatenate([s.vertices for s in stores]), offsets,
+                   np.concatenate([s.layers for s in stores]), np.concatenate([s.datatypes for s in stores]))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.vertices[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        return iter(np.split(self.vertices, self.offsets[1:-1]))
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    def copy(self):
+        return PolygonStore(self.vertices.copy(), self.offsets.copy(), self.layers, self.datatypes)
+
+    # Returns a store with the polygons on the given layers, as ints or (layer, datatype) tuples
+    def extract(self, layers):
+        keep = np.zeros(len(self), dtype=bool)
+        for l in layers:
+            if np.size(l) == 2:
+                keep |= (self.layers == l[0]) & (self.datatypes == l[1])
+            else:
+                keep |= self.layers == l
+        return self.take(keep)
+
+    # Returns a store with the polygons selected by a boolean mask or an array of indices
+    def take(self, keep):
+        counts = self.counts[keep]
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        index = np.repeat(self.offsets[:-1][keep] - offsets[:-1], counts) + np.arange(offsets[-1])
+        return PolygonStore(self.vertices[index], offsets, self.layers[keep], self.datatypes[keep])
+
+    # Returns a store with the polygons reflected, magnified and rotated like a reference, and placed at
+    # each of the (m, 2) origins
+    def placed(self, origins, rotation=0, magnification=1, x_reflection=False):
+        S = self.copy()
+        if len(S) == 0:
+            return S
+        if x_reflection:
+            S.vertices[:, 1] *= -1
+        S.vertices *= magnification
+        return S.rotate(rotation).tile(origins)
+
+    # Returns a store with a copy of all polygons at each of the (m, 2) shifts
+    def tile(self, shifts):
+        shifts = np.asarray(shifts, dtype=float)
+        m, n = len(shifts), len(self.vertices)
+        vertices = (self.vertices[None, :, :] + shifts[:, None, :]).reshape(-1, 2)
+        offsets = np.concatenate([[0], (self.offsets[1:][None, :] + n*np.arange(m)[:, None]).ravel()])
+        return PolygonStore(vertices, offsets, np.tile(self.layers, m), np.tile(self.datatypes, m))
+
+    def bboxes(self):
+        starts = self.offsets[:-1]
+        lo = np.stack([np.minimum.reduceat(self.vertices[:, k], starts) for k in (0, 1)], axis=-1)
+        hi = np.stack([np.maximum.reduceat(self.vertices[:, k], starts) for k in (0, 1)], axis=-1)
+        return np.stack([lo, hi], axis=1)
+
+    @property
+    def bbox(self):
+        if len(self.vertices) == 0:
+            return np.array([[0, 0], [0, 0]], dtype=float)
+        return np.array([self.vertices.min(axis=0), self.vertices.max(axis=0)])
+
+    @property
+    def xmin(self):
+        return self.bbox[0][0]
+
+    @property
+    def ymin(self):
+        return self.bbox[0][1]
+
+    @property
+    def xmax(self):
+        return self.bbox[1][0]
+
+    @property
+    def ymax(self):
+        return self.bbox[1][1]
+
+    @property
+    def size(self):
+        bbox = self.bbox
+        return bbox[1] - bbox[0]
+
+    @property
+    def xsize(self):
+        return self.size[0]
+
+    @property
+    def ysize(self):
+        return self.size[1]
+
+    @property
+    def center(self):
+        return np.sum(self.bbox, 0)/2
+
+    @property
+    def x(self):
+        return self.center[0]
+
+    @property
+    def y(self):
+        return self.center[1]
+
+    def areas(self):
+        if len(self) == 0:
+            return np.zeros(0)
+        nxt = np.arange(1, len(self.vertices) + 1)
+        nxt[self.offsets[1:] - 1] = self.offsets[:-1]
+        x, y = self.vertices.T
+        return np.abs(np.add.reduceat(x*y[nxt] - x[nxt]*y, self.offsets[:-1])) / 2
+
+    def area(self, by_spec=False):
+        areas = self.areas()
+        if not by_spec:
+            return areas.sum()
+        specs, inverse = np.unique(np.stack([self.layers, self.datatypes], axis=1), axis=0, return_inverse=True)
+        totals = np.bincount(inverse.ravel(), weights=areas, minlength=len(specs))
+        return {tuple(int(v) for v in s): a for s, a in zip(specs, totals)}
+
+    def translate(self, dx=0, dy=0):
+        self.vertices += (dx, dy)
+        return self
+
+    def rotate(self, angle=45, center=(0, 0)):
+        if angle != 0:
+            self.vertices = _rotate_points(self.vertices, angle, center)
+        return self
+
+    def mirror(self, p1=(0, 1), p2=(0, 0)):
+        self.vertices = _reflect_points(self.vertices, p1, p2)
+        return self
+
+    def get_polygons(self, by_spec=False):
+        polygons = list(self)
+        if not by_spec:
+            return polygons
+        out = {}
+        for p, l, d in zip(polygons, self.layers, self.datatypes):
+            out.setdefault((int(l), int(d)), []).append(p)
+        return out
+
+    # Builds a Device with one polygon set per layer, whose polygons are views into the vertex buffer
+    def to_device(self, name='Compact'):
+        D = Device(name)
+        for (l, d), polygons in self.get_polygons(by_spec=True).items():
+            P = gdspy.PolygonSet([], layer=l, datatype=d)
+            P.polygons = polygons
+            P.layers = [l] * len(polygons)
+            P.datatypes = [d] * len(polygons)
+            D.add(P)
+        return D
+
+    # Writes the store as a single flat GDS cell. All element records are assembled in one
+    # big-endian word buffer instead of being packed polygon by polygon.
+    def write_gds(self, filename, cellname='toplevel', unit=1e-6, precision=1e-9):
+        if not filename.endswith('.gds'):
+            filename += '.gds'
+        counts = self.counts
+        if len(counts) and counts.max() > 8190:
+            raise ValueError('[DeviceLib] write_gds() supports at most 8190 vertices per polygon')
+        n = len(self)
+        coords = np.round(self.vertices * (unit/precision)).astype('>i4').view('>u2').ravel()
+        header = np.empty((n, 10), dtype=np.int64)
+        header[:] = (4, 0x0800, 6, 0x0D02, 0, 6, 0x0E02, 0, 0, 0x1003)
+        header[:, 4] = self.layers
+        header[:, 7] = self.datatypes
+        header[:, 8] = 4 + 8*(counts + 1)
+        # Between two polygons goes the closing vertex and ENDEL of the first and the header of the second
+        joints = np.empty((n + 1, 16), dtype='>u2')
+        joints[1:, :4] = coords.reshape(-1, 4)[self.offsets[:-1]]
+        joints[1:, 4:6] = (4, 0x1100)
+        joints[:-1, 6:] = header
+        lengths = np.full(n + 1, 16)
+        lengths[0], lengths[-1] = 10, 6
+        buf = np.insert(coords, np.repeat(4*self.offsets, lengths), joints.ravel()[6:-10]) if n else coords
+
+        def record(rtype, data=b''):
+            return struct.pack('>2H', 4 + len(data), rtype) + data
+
+        def name(s):
+            s = s.encode('ascii')
+            return s + b'\0' * (len(s) % 2)
+
+        stamp = struct.pack('>12H', *([1970, 1, 1, 0, 0, 0] * 2))
+        with open(filename, 'wb') as f:
+            f.write(record(0x0002, struct.pack('>H', 600)) + record(0x0102, stamp) + record(0x0206, name('library')))
+            f.write(record(0x0305, _eight_byte_real(precision/unit) + _eight_byte_real(precision)))
+            f.write(record(0x0502, stamp) + record(0x0606, name(cellname)))
+            f.write(buf.tobytes())
+            f.write(record(0x0700) + record(0x0400))
+        return filename
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+import zlib
+import struct
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+_COLORS = np.array([[31, 119, 180], [255, 127, 14], [44, 160, 44], [214, 39, 40], [148, 103, 189],
+                    [140, 86, 75], [227, 119, 194], [127, 127, 127], [188, 189, 34], [23, 190, 207]])
+
+def _rasterize(target, polygons, tx, ty, ps):
+    # Adds the coverage of polygons to target, whose pixel (0, 0) is pixel (tx, ty) of the layout grid.
+    # Polygons thinner than a pixel become boxes shaded by their area, the rest is scanline filled.
+    h, w = target.shape
+    counts = np.array([len(p) for p in polygons])
+    offsets = np.r_[0, np.cumsum(counts)]
+    pts = np.concatenate(polygons) / ps - (tx, ty)
+    starts = offsets[:-1]
+    lo = np.stack([np.minimum.reduceat(pts[:, k], starts) for k in (0, 1)], axis=1)
+    hi = np.stack([np.maximum.reduceat(pts[:, k], starts) for k in (0, 1)], axis=1)
+    inside = (hi[:, 0] >= 0) & (lo[:, 0] < w) & (hi[:, 1] >= 0) & (lo[:, 1] < h)
+    small = np.any(hi - lo < 1, axis=1)
+    nxt = np.arange(1, len(pts) + 1)
+    nxt[offsets[1:] - 1] = starts
+
+    shaded = np.flatnonzero(small & inside)
+    if len(shaded):
+        x, y = pts.T
+        areas = np.abs(np.add.reduceat(x*y[nxt] - x[nxt]*y, starts))[shaded] / 2
+        c0, r0 = np.floor(lo[shaded]).astype(int).T
+        c1, r1 = np.floor(hi[shaded]).astype(int).T
+        value = areas / ((c1 - c0 + 1) * (r1 - r0 + 1))
+        c0, c1 = np.clip(c0, 0, w - 1), np.clip(c1, 0, w - 1) + 1
+        r0, r1 = np.clip(r0, 0, h - 1), np.clip(r1, 0, h - 1) + 1
+        box = np.zeros((h + 1, w + 1))
+        np.add.at(box, (r0, c0), value)
+        np.add.at(box, (r0, c1), -value)
+        np.add.at(box, (r1, c0), -value)
+        np.add.at(box, (r1, c1), value)
+        target += box.cumsum(0).cumsum(1)[:h, :w]
+
+    filled = ~small & inside
+    if filled.any():
+        poly = np.repeat(np.arange(len(polygons)), counts)
+        edges = np.flatnonzero(filled[poly])
+        x1, y1 = pts[edges].T
+        x2, y2 = pts[nxt[edges]].T
+        first = np.clip(np.ceil(np.minimum(y1, y2) - 0.5), 0, h).astype(int)
+        last = np.clip(np.ceil(np.maximum(y1, y2) - 0.5), 0, h).astype(int)
+        n = last - first
+        keep = n > 0
+        edges, x1, y1, x2, y2, first, n = edges[keep], x1[keep], y1[keep], x2[keep], y2[keep], first[keep], n[keep]
+        e = np.repeat(np.arange(len(edges)), n)
+        row = first[e] + np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        xc = x1[e] + (row + 0.5 - y1[e]) * (x2[e] - x1[e]) / (y2[e] - y1[e])
+        order = np.lexsort((xc, row, poly[edges][e]))
+        row, xc = row[order], xc[order]
+        row, xa, xb = row[0::2], xc[0::2], xc[1::2]
+        c0 = np.clip(np.ceil(xa - 0.5), 0, w).astype(int)
+        c1 = np.clip(np.ceil(xb - 0.5), 0, w).astype(int)
+        span = np.zeros((h, w + 1))
+        np.add.at(span, (row, c0), 1)
+        np.add.at(span, (row, c1), -1)
+        target += np.minimum(span.cumsum(1)[:, :w], 1)
+
+def _orient(image, quadrant, reflect):
+    # Applies an x reflection followed by a rotation by quadrant*90 degrees to a cell image
+    layers, ox, oy = image
+    h, w = next(iter(layers.values())).shape
+    if reflect:
+        layers, oy = {l: a[::-1] for l, a in layers.items()}, -(oy + h)
+    if quadrant == 1:
+        return {l: a.T[:, ::-1] for l, a in layers.items()}, -(oy + h), ox
+    if quadrant == 2:
+        return {l: a[::-1, ::-1] for l, a in layers.items()}, -(ox + w), -(oy + h)
+    if quadrant == 3:
+        return {l: a.T[::-1, :] for l, a in layers.items()}, oy, -(ox + w)
+    return layers, ox, oy
+
+def _blit(target, image, positions, tx, ty):
+    # Adds image at every (n, 2) pixel position, clipped to the target window
+    h, w = target.shape
+    ih, iw = image.shape
+    px, py = positions[:, 0] - tx, positions[:, 1] - ty
+    hit = (px < w) & (px + iw > 0) & (py < h) & (py + ih > 0)
+    px, py = px[hit], py[hit]
+    if len(px) > ih * iw:
+        for r, c in zip(*np.nonzero(image)):
+            x, y = px + c, py + r
+            ok = (x >= 0) & (x < w) & (y >= 0) & (y < h)
+            np.add.at(target, (y[ok], x[ok]), image[r, c])
+        return
+    for x, y in zip(px, py):
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + iw, w), min(y + ih, h)
+        target[y0:y1, x0:x1] += image[y0 - y:y1 - y, x0 - x:x1 - x]
+
+def _placements(cell):
+    # Groups the references of cell by child and orientation, with all their origins in one array
+    groups, other = {}, []
+    for ref in cell.references:
+        rotation = (ref.rotation or 0) % 360
+        if (ref.magnification or 1) != 1 or rotation % 90 != 0:
+            other.append(ref)
+            continue
+        origins = np.array([ref.origin], dtype=float)
+        columns, rows = getattr(ref, 'columns', 1), getattr(ref, 'rows', 1)
+        if columns * rows > 1:
+            ca, sa = np.cos(np.radians(rotation)), np.sin(np.radians(rotation))
+            sx, sy = ref.spacing[0], -ref.spacing[1] if ref.x_reflection else ref.spacing[1]
+            i, j = np.meshgrid(np.arange(columns), np.arange(rows))
+            origins = origins + np.outer(i.ravel(), (sx*ca, sx*sa)) + np.outer(j.ravel(), (-sy*sa, sy*ca))
+        key = (ref.parent.uid, int(rotation // 90), bool(ref.x_reflection))
+        groups.setdefault(key, (ref.parent, []))[1].append(origins)
+    return [(k, c, np.concatenate(v)) for k, (c, v) in groups.items()], other
+
+def _walk(cell, info):
+    # Collects depth, bounding box, layers and placements of cell and all cells below it, visiting each
+    # unique cell once. Equivalent to the gdspy queries, which revisit shared cells for every reference.
+    if cell.uid in info:
+        return info[cell.uid]
+    groups, other = _placements(cell)
+    depth, layers, boxes = 0, set(), []
+    for polygonset in cell.polygons:
+        layers.update(polygonset.layers)
+        if polygonset.polygons:
+            pts = np.concatenate(polygonset.polygons)
+            boxes.append([pts.min(axis=0), pts.max(axis=0)])
+    for (_, quadrant, reflect), child, origins in groups:
+        d, bbox, l = _walk(child, info)[:3]
+        depth, layers = max(depth, d + 1), layers | l
+        if bbox is not None:
+            corners = np.array([[bbox[0][0], bbox[0][1]], [bbox[1][0], bbox[1][1]]])
+            if reflect:
+                corners[:, 1] *= -1
+            ca, sa = [(1, 0), (0, 1), (-1, 0), (0, -1)][quadrant]
+            corners = np.array([[ca, -sa], [sa, ca]]) @ corners.T
+            boxes.append([origins.min(axis=0) + corners.min(axis=1), origins.max(axis=0) + corners.max(axis=1)])
+    for ref in other:
+        d, _, l = _walk(ref.parent, info)[:3]
+        depth, layers = max(depth, d + 1), layers | l
+        bbox = ref.get_bounding_box()
+        if bbox is not None:
+            boxes.append(bbox)
+    bbox = None
+    if boxes:
+        boxes = np.array(boxes)
+        bbox = np.array([boxes[:, 0].min(axis=0), boxes[:, 1].max(axis=0)])
+    info[cell.uid] = (depth, bbox, layers, (groups, other), cell)
+    return info[cell.uid]
+
+def _compose(cell, target, tx, ty, ps, images, placements):
+    # Renders the polygons of cell and the cached images of its references into the target layers
+    for layer, polygons in _own_polygons(cell).items():
+        if layer in target and polygons:
+            _rasterize(target[layer], polygons, tx, ty, ps)
+    groups, other = placements
+    for (uid, quadrant, reflect), _, origins in groups:
+        if images.get(uid) is None or not target:
+            continue
+        layers, ox, oy = _orient(images[uid], quadrant, reflect)
+        positions = np.round(origins / ps).astype(int) + (ox, oy)
+        for layer, a in layers.items():
+            if layer in target:
+                _blit(target[layer], a, positions, tx, ty)
+    # Magnified and off-axis references are rasterized from their transformed polygons
+    for ref in other:
+        for (layer, _), polygons in ref.get_polygons(by_spec=True).items():
+            if layer in target and polygons:
+                _rasterize(target[layer], polygons, tx, ty, ps)
+
+def _own_polygons(cell):
+    out = {}
+    for polygonset in cell.polygons:
+        for p, l in zip(polygonset.polygons, polygonset.layers):
+            out.setdefault(l, []).append(p)
+    return out
+
+def _window(bbox, ps):
+    ox, oy = int(np.floor(bbox[0][0] / ps)), int(np.floor(bbox[0][1] / ps))
+    w = max(int(np.ceil(bbox[1][0] / ps)) - ox, 1)
+    h = max(int(np.ceil(bbox[1][1] / ps)) - oy, 1)
+    return ox, oy, w, h
+
+def _write_png(filename, rgb):
+    h, w, _ = rgb.shape
+    raw = np.concatenate([np.zeros((h, 1), dtype=np.uint8), rgb.reshape(h, 3*w)], axis=1).tobytes()
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>2I5B', w, h, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw, 6)))
+        f.write(chunk(b'IEND', b''))
+
+# Renders a raster preview of a Device without flattening it
+#   device --> Device to be rendered
+#   filename --> PNG file to write, or None to only return the image
+#   width --> width of the image in pixels, ignored if pixel_size is given
+#   pixel_size --> size of a pixel in layout units
+#   layers --> layers to render, all layers if None
+#   tile --> size of the square tiles the top cell is rendered in, in pixels
+#   workers --> number of threads for cells and tiles
+#   alpha --> opacity of a fully covered pixel of a layer
+#
+# Every unique cell is rasterized once at the preview resolution and its image is added at each
+# reference and array element. Polygons thinner than a pixel are drawn as boxes shaded by their area,
+# so sub-pixel fills come out as a gray density instead of disappearing.
+# Returns the (height, width, 3) uint8 RGB image, top row first.
+def preview(device, filename=None, width=2000, pixel_size=None, layers=None, tile=512, workers=None, alpha=0.6):
+    info = {}
+    _walk(device, info)
+    if pixel_size is None:
+        size = np.ptp(info[device.uid][1], axis=0) if info[device.uid][1] is not None else (0, 0)
+        pixel_size = max(max(size) / width, 1e-9)
+    ps = pixel_size
+    if layers is None:
+        layers = sorted(info[device.uid][2])
+    images = {}
+
+    def render(uid):
+        _, bbox, _, placements, cell = info[uid]
+        if bbox is None:
+            return uid, None
+        ox, oy, w, h = _window(bbox, ps)
+        target = {l: np.zeros((h, w)) for l in layers}
+        _compose(cell, target, ox, oy, ps, images, placements)
+        return uid, ({l: np.minimum(a, 1) for l, a in target.items()}, ox, oy)
+
+    top_depth, bbox, _, top, _ = info[device.uid]
+    ox, oy, w, h = _window(bbox if bbox is not None else np.zeros((2, 2)), ps)
+    canvas = {l: np.zeros((h, w)) for l in layers}
+
+    def render_tile(rc):
+        r, c = rc
+        th, tw = min(tile, h - r), min(tile, w - c)
+        target = {l: np.zeros((th, tw)) for l in layers}
+        _compose(device, target, ox + c, oy + r, ps, images, top)
+        for l, a in target.items():
+            canvas[l][r:r + th, c:c + tw] = np.minimum(a, 1)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for d in range(top_depth):
+            images.update(pool.map(render, [u for u, v in info.items() if v[0] == d and u != device.uid]))
+        list(pool.map(render_tile, [(r, c) for r in range(0, h, tile) for c in range(0, w, tile)]))
+
+    rgb = np.full((h, w, 3), 255.0)
+    for l in layers:
+        a = alpha * canvas[l][..., None]
+        rgb = rgb * (1 - a) + _COLORS[l % len(_COLORS)] * a
+    rgb = np.round(rgb[::-1]).astype(np.uint8)
+    if filename is not None:
+        if not filename.endswith('.png'):
+            filename += '.png'
+        _write_png(filename, rgb)
+    return rgb
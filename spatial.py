@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from .polystore import PolygonStore, _origins
+
+# Boxes covering more buckets than this are not spread over the grid but tested against every query
+_SPAN = 64
+# Points handled at once by distance queries
+_CHUNK = 1 << 14
+
+def _cover(lo, hi):
+    # Buckets covered by the integer ranges [lo, hi] of each row, as (row, i, j) triples
+    n = hi - lo + 1
+    count = n[:, 0] * n[:, 1]
+    row = np.repeat(np.arange(len(n)), count)
+    k = np.arange(len(row)) - np.repeat(np.cumsum(count) - count, count)
+    return row, lo[row, 0] + k % n[row, 0], lo[row, 1] + k // n[row, 0]
+
+def _spread(a, b):
+    # Positions a[i] to b[i] - 1 of every row, as (row, position) pairs
+    n = b - a
+    row = np.repeat(np.arange(len(n)), n)
+    return row, np.repeat(a - np.cumsum(n) + n, n) + np.arange(len(row))
+
+def _bucket(bboxes):
+    # Bucket size of about one box per bucket, but not smaller than a typical box
+    lo, hi = bboxes[:, :2].min(axis=0), bboxes[:, 2:].max(axis=0)
+    extent = np.max(hi - lo)
+    typical = np.median(np.maximum(bboxes[:, 2] - bboxes[:, 0], bboxes[:, 3] - bboxes[:, 1]))
+    size = max(typical, np.sqrt(np.prod(hi - lo) / len(bboxes)), extent / 2**30)
+    return size if size > 0 else 1.0
+
+def _transformed(box, rotation, magnification, x_reflection):
+    # Box around a (4,) box reflected, magnified and rotated like a reference
+    x, y = np.array([[box[0], box[0], box[2], box[2]], [box[1], box[3], box[1], box[3]]]) * magnification
+    if x_reflection:
+        y = -y
+    ca, sa = np.cos(np.radians(rotation)), np.sin(np.radians(rotation))
+    x, y = x*ca - y*sa, x*sa + y*ca
+    return np.array([x.min(), y.min(), x.max(), y.max()])
+
+def _local(boxes, origins, rotation, magnification, x_reflection):
+    # Boxes (k, 4) around the query boxes seen from references placed at origins (k, 2)
+    x = boxes[:, [0, 0, 2, 2]] - origins[:, :1]
+    y = boxes[:, [1, 3, 1, 3]] - origins[:, 1:]
+    ca, sa = np.cos(np.radians(rotation)), np.sin(np.radians(rotation))
+    x, y = (x*ca + y*sa) / magnification, (y*ca - x*sa) / magnification
+    if x_reflection:
+        y = -y
+    return np.stack([x.min(axis=1), y.min(axis=1), x.max(axis=1), y.max(axis=1)], axis=1)
+
+def _wanted(spec, layers):
+    if layers is None:
+        return True
+    return any(spec == tuple(l) if np.size(l) == 2 else spec[0] == l for l in layers)
+
+def _segments(P, a, d):
+    # Distance from points P to the segments from a to a + d
+    t = np.clip(np.sum((P - a) * d, axis=1) / np.maximum(np.sum(d * d, axis=1), 1e-300), 0, 1)
+    return np.hypot(*(P - a - t[:, None] * d).T)
+
+# Uniform bucket grid over boxes given as (xmin, ymin, xmax, ymax) rows. Bucket keys are kept in a
+# large sorted table and a small one that takes additions, so adding boxes does not re-sort everything.
+class _Grid(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.bboxes = np.zeros((0, 4))
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.large = np.zeros(0, dtype=np.int64)
+        self.tables = [(np.zeros(0, dtype=np.int64),) * 2, (np.zeros(0, dtype=np.int64),) * 2]
+        self.lo = self.hi = None
+
+    def extend(self, bboxes, ids):
+        first = len(self.bboxes)
+        self.bboxes = np.concatenate([self.bboxes, bboxes])
+        self.ids = np.concatenate([self.ids, ids])
+        lo = np.floor(bboxes[:, :2] / self.size).astype(np.int64)
+        hi = np.floor(bboxes[:, 2:] / self.size).astype(np.int64)
+        slots = first + np.arange(len(bboxes))
+        big = np.prod(hi - lo + 1, axis=1) > _SPAN
+        self.large = np.r_[self.large, slots[big]]
+        lo, hi, slots = lo[~big], hi[~big], slots[~big]
+        if len(slots) == 0:
+            return
+        self.lo = lo.min(axis=0) if self.lo is None else np.minimum(self.lo, lo.min(axis=0))
+        self.hi = hi.max(axis=0) if self.hi is None else np.maximum(self.hi, hi.max(axis=0))
+        row, i, j = _cover(lo, hi)
+        (K, I), (k, s) = self.tables
+        k, s = np.r_[k, (i << 32) + j], np.r_[s, slots[row]]
+        if len(k) > max(4096, len(K) // 4):
+            K, I = np.r_[K, k], np.r_[I, s]
+            order = np.argsort(K, kind='stable')
+            self.tables = [(K[order], I[order]), (k[:0], s[:0])]
+        else:
+            order = np.argsort(k, kind='stable')
+            self.tables = [(K, I), (k[order], s[order])]
+
+    # Returns (row, id) pairs of the query boxes (k, 4) and the stored boxes touching them
+    def pairs(self, boxes):
+        rows, slots = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        brute = np.zeros(len(boxes), dtype=bool)
+        if self.lo is not None and len(boxes):
+            lo = np.maximum(np.floor(boxes[:, :2] / self.size), self.lo)
+            hi = np.minimum(np.floor(boxes[:, 2:] / self.size), self.hi)
+            n = np.prod(hi - lo + 1, axis=1)
+            # Boxes covering more buckets than there are boxes stored are tested against all of them
+            brute = n > len(self.bboxes)
+            rows.append(np.repeat(np.flatnonzero(brute), len(self.bboxes)))
+            slots.append(np.tile(np.arange(len(self.bboxes)), brute.sum()))
+            ok = np.flatnonzero(~brute & np.all(hi >= lo, axis=1))
+            row, i, j = _cover(lo[ok].astype(np.int64), hi[ok].astype(np.int64))
+            keys = (i << 32) + j
+            for K, I in self.tables:
+                r, pos = _spread(np.searchsorted(K, keys, 'left'), np.searchsorted(K, keys, 'right'))
+                # A pair is found in every bucket both boxes cover, it is kept in the one with the lower left corner
+                # of their overlap
+                first = np.floor(np.maximum(boxes[ok[row[r]], :2], self.bboxes[I[pos], :2]) / self.size)
+                keep = (first[:, 0] == i[r]) & (first[:, 1] == j[r])
+                rows.append(ok[row[r[keep]]])
+                slots.append(I[pos[keep]])
+        if len(self.large):
+            rows.append(np.repeat(np.flatnonzero(~brute), len(self.large)))
+            slots.append(np.tile(self.large, np.sum(~brute)))
+        rows, slots = np.concatenate(rows), np.concatenate(slots)
+        b, q = self.bboxes[slots], boxes[rows]
+        hit = (b[:, 0] <= q[:, 2]) & (b[:, 2] >= q[:, 0]) & (b[:, 1] <= q[:, 3]) & (b[:, 3] >= q[:, 1])
+        return rows[hit], self.ids[slots[hit]]
+
+# Index of one unique cell in its own coordinates
+#   counts --> number of polygon sets, paths and references indexed so far
+#   stores, grids --> (layer, datatype) : own polygons of the cell and a grid over them
+#   groups --> (child, rotation, magnification, x_reflection) of the referenced cells
+#   group, origins --> group and origin of every referenced instance, instances is a grid over them
+#   edges --> (layer, datatype) : (start, direction, polygon, grid) of the polygon edges, made on demand
+#   bbox, version --> bounding box of the cell, version changes whenever the bbox does
+#   manhattan --> whether all references below are rotated by multiples of 90 degrees, otherwise bbox is larger
+class _Cell(object):
+
+    def __init__(self, cell):
+        self.cell = cell
+        self.counts = (0, 0, 0)
+        self.stores, self.grids, self.edges = {}, {}, {}
+        self.groups, self.keys, self.seen = [], {}, []
+        self.group = np.zeros(0, dtype=np.int64)
+        self.origins = np.zeros((0, 2))
+        self.instances = None
+        self.bbox = None
+        self.version = 0
+        self.manhattan = True
+        self.specs = set()
+        self.stamp = None
+
+# Spatial index over the polygons of a Device and everything it references
+#   device --> Device to index
+#
+# Every unique cell gets a bucket grid per layer over its own polygons and one over the instances of
+# the cells it references. Grids are built on the first query and extended when later queries find
+# polygons or references that were added to a cell in the meantime; those are indexed where they are
+# at that point. Queries walk down the hierarchy only through the instances they touch, with all
+# query boxes at once. Call refresh() after moving or removing elements that were already indexed.
+class SpatialIndex(object):
+
+    def __init__(self, device):
+        self.device = device
+        self._cells = {}
+        self._stamp = 0
+        self._version = 0
+
+    def _sync(self, cell):
+        c = self._cells.get(cell.uid)
+        if c is not None and c.stamp == self._stamp:
+            return c
+        if c is None:
+            c = self._cells[cell.uid] = _Cell(cell)
+        polygons, paths, references = cell.polygons, getattr(cell, 'paths', []), cell.references
+        counts = (len(polygons), len(paths), len(references))
+        if any(n < m for n, m in zip(counts, c.counts)):
+            c = self._cells[cell.uid] = _Cell(cell)
+        c.stamp = self._stamp
+        boxes = []
+
+        # New polygons go to the grid of their layer
+        S = PolygonStore.from_elements(polygons[c.counts[0]:], paths[c.counts[1]:])
+        if len(S):
+            specs, inverse = np.unique(np.stack([S.layers, S.datatypes], axis=1), axis=0, return_inverse=True)
+            inverse = inverse.ravel()
+            for n, spec in enumerate(specs):
+                spec = (int(spec[0]), int(spec[1]))
+                part = S.take(inverse == n)
+                bboxes = part.bboxes().reshape(-1, 4)
+                old = c.stores.get(spec, PolygonStore())
+                if spec not in c.grids:
+                    c.grids[spec] = _Grid(_bucket(bboxes))
+                c.grids[spec].extend(bboxes, len(old) + np.arange(len(part)))
+                c.stores[spec] = PolygonStore.concatenate([old, part])
+                c.edges.pop(spec, None)
+                boxes.append(bboxes)
+            c.specs.update(c.stores)
+
+        # Children are brought up to date first, the boxes of the instances depend on theirs
+        stale = False
+        for gid, (child, _, _, _) in enumerate(c.groups):
+            self._sync(child.cell)
+            stale |= child.version != c.seen[gid]
+        first = 0 if stale else len(c.group)
+        group, origins = [c.group], [c.origins]
+        for ref in references[c.counts[2]:]:
+            child = self._sync(ref.parent)
+            key = (ref.parent.uid, ref.rotation or 0, ref.magnification or 1, bool(ref.x_reflection))
+            if key not in c.keys:
+                c.keys[key] = len(c.groups)
+                c.groups.append((child,) + key[1:])
+                c.seen.append(child.version)
+            o = _origins(ref)
+            group.append(np.full(len(o), c.keys[key]))
+            origins.append(o)
+        c.group, c.origins = np.concatenate(group), np.concatenate(origins)
+        c.counts = counts
+        for child, rotation, _, _ in c.groups:
+            c.specs.update(child.specs)
+            c.manhattan &= child.manhattan and rotation % 90 == 0
+
+        if stale:
+            c.seen = [child.version for child, _, _, _ in c.groups]
+            c.instances = None
+            boxes = [np.concatenate([g.bboxes for g in c.grids.values()])] if c.grids else []
+        if first < len(c.group):
+            group, origins = c.group[first:], c.origins[first:]
+            bboxes = np.full((len(group), 4), np.nan)
+            for gid in np.unique(group):
+                child, rotation, magnification, x_reflection = c.groups[gid]
+                if child.bbox is not None:
+                    sel = group == gid
+                    bboxes[sel] = np.tile(origins[sel], 2) + _transformed(child.bbox, rotation, magnification, x_reflection)
+            valid = ~np.isnan(bboxes[:, 0])
+            if valid.any():
+                if c.instances is None:
+                    c.instances = _Grid(_bucket(bboxes[valid]))
+                c.instances.extend(bboxes[valid], first + np.flatnonzero(valid))
+                boxes.append(bboxes[valid])
+
+        # The bbox only grows, unless the cell was indexed again from scratch
+        if boxes:
+            boxes = np.concatenate(boxes)
+            bbox = np.r_[boxes[:, :2].min(axis=0), boxes[:, 2:].max(axis=0)]
+            if c.bbox is not None and not stale:
+                bbox = np.r_[np.minimum(bbox[:2], c.bbox[:2]), np.maximum(bbox[2:], c.bbox[2:])]
+            if c.bbox is None or np.any(bbox != c.bbox):
+                self._version += 1
+                c.bbox, c.version = bbox, self._version
+        return c
+
+    def _update(self):
+        self._stamp += 1
+        return self._sync(self.device)
+
+    def _query(self, c, boxes, layers):
+        # Polygons of cell c touching the boxes (k, 4), in its own coordinates, with the box each was found with
+        parts, rows = [], []
+        for spec, grid in c.grids.items():
+            if _wanted(spec, layers):
+                r, i = grid.pairs(boxes)
+                if len(i):
+                    parts.append(c.stores[spec].take(i))
+                    rows.append(r)
+        if c.instances is not None:
+            r, i = c.instances.pairs(boxes)
+            group = c.group[i]
+            for gid in np.unique(group):
+                child, rotation, magnification, x_reflection = c.groups[gid]
+                if not any(_wanted(spec, layers) for spec in child.specs):
+                    continue
+                sel = group == gid
+                origins = c.origins[i[sel]]
+                S, j = self._query(child, _local(boxes[r[sel]], origins, rotation, magnification, x_reflection), layers)
+                if len(S):
+                    S = S.placed(np.zeros((1, 2)), rotation, magnification, x_reflection)
+                    S.vertices += np.repeat(origins[j], S.counts, axis=0)
+                    parts.append(S)
+                    rows.append(r[sel][j])
+        if not parts:
+            return PolygonStore(), np.zeros(0, dtype=np.int64)
+        return PolygonStore.concatenate(parts), np.concatenate(rows)
+
+    def _edges(self, c, spec):
+        if spec not in c.edges:
+            S = c.stores[spec]
+            nxt = np.arange(1, len(S.vertices) + 1)
+            nxt[S.offsets[1:] - 1] = S.offsets[:-1]
+            a, b = S.vertices, S.vertices[nxt]
+            bboxes = np.c_[np.minimum(a, b), np.maximum(a, b)]
+            grid = _Grid(_bucket(bboxes))
+            grid.extend(bboxes, np.arange(len(a)))
+            c.edges[spec] = (a, b - a, np.repeat(np.arange(len(S)), S.counts), grid)
+        return c.edges[spec]
+
+    def _nearest(self, c, points, limits, layers):
+        # Distances from points to the polygons of cell c within limits, in its own coordinates
+        distance = np.full(len(points), np.inf)
+        for spec, grid in c.grids.items():
+            if not _wanted(spec, layers):
+                continue
+            a, d, polygon, edges = self._edges(c, spec)
+            r, e = edges.pairs(np.c_[points - limits[:, None], points + limits[:, None]])
+            np.minimum.at(distance, r, _segments(points[r], a[e], d[e]))
+            # Points in a polygon's bbox are inside if a ray to the nearer side of the bbox crosses its edges an odd
+            # number of times
+            r, i = grid.pairs(np.c_[points, points])
+            P = points[r]
+            left = P[:, 0] - grid.bboxes[i, 0] < grid.bboxes[i, 2] - P[:, 0]
+            end = np.where(left, grid.bboxes[i, 0], grid.bboxes[i, 2])
+            k, e = edges.pairs(np.c_[np.minimum(P[:, 0], end), P[:, 1], np.maximum(P[:, 0], end), P[:, 1]])
+            k, e = k[polygon[e] == i[k]], e[polygon[e] == i[k]]
+            y, ay, by = P[k, 1], a[e, 1], a[e, 1] + d[e, 1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                crossing = ((ay > y) != (by > y)) & ((P[k, 0] < a[e, 0] + (y - ay) * d[e, 0] / d[e, 1]) != left[k])
+            inside = np.bincount(k[crossing], minlength=len(r)) % 2 == 1
+            distance[r[inside]] = 0
+        if c.instances is not None:
+            r, i = c.instances.pairs(np.c_[points - limits[:, None], points + limits[:, None]])
+            group = c.group[i]
+            for gid in np.unique(group):
+                child, rotation, magnification, x_reflection = c.groups[gid]
+                if not any(_wanted(spec, layers) for spec in child.specs):
+                    continue
+                sel = group == gid
+                P = points[r[sel]]
+                local = _local(np.c_[P, P], c.origins[i[sel]], rotation, magnification, x_reflection)[:, :2]
+                found = self._nearest(child, local, limits[r[sel]] / magnification, layers) * magnification
+                np.minimum.at(distance, r[sel], found)
+        return distance
+
+    # Adds an element to the device and indexes it right away
+    def add(self, element):
+        self.device.add(element)
+        self._update()
+        return element
+
+    # Forgets everything indexed so far, the next query indexes the device again
+    def refresh(self):
+        self._cells = {}
+
+    # Returns a flat store with the polygons whose bounding boxes touch any of the boxes
+    #   boxes --> a ((xmin, ymin), (xmax, ymax)) box or a list of them
+    #   layers --> ints or (layer, datatype) tuples, all layers if None
+    #
+    # Polygons touching several boxes are returned once.
+    def query(self, boxes, layers=None):
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        S, rows = self._query(self._update(), boxes, layers)
+        if len(S):
+            # Boxes seen from rotated references are larger, so the hits are checked once more here
+            b, q = S.bboxes().reshape(-1, 4), boxes[rows]
+            S = S.take((b[:, 0] <= q[:, 2]) & (b[:, 2] >= q[:, 0]) & (b[:, 1] <= q[:, 3]) & (b[:, 3] >= q[:, 1]))
+        if len(boxes) > 1 and len(S):
+            keys = np.c_[S.layers, S.datatypes, S.counts, S.vertices[S.offsets[:-1]], S.bboxes().reshape(-1, 4)]
+            S = S.take(np.sort(np.unique(keys, axis=0, return_index=True)[1]))
+        return S
+
+    # Returns the distance from each of the points (n, 2) to the nearest polygon, zero inside polygons
+    # and inf where there is none within limit
+    def nearest(self, points, limit, layers=None):
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        c = self._update()
+        distance = np.concatenate([np.zeros(0)] + [self._nearest(c, P, np.full(len(P), float(limit)), layers)
+                                                   for P in np.split(points, np.arange(_CHUNK, len(points), _CHUNK))])
+        distance[distance > limit] = np.inf
+        return distance
+
+    # Bounding box of the device, taken from the index unless references are rotated by odd angles
+    @property
+    def bbox(self):
+        c = self._update()
+        if not c.manhattan:
+            return self.device.bbox
+        if c.bbox is None:
+            return np.array([[0, 0], [0, 0]], dtype=float)
+        return c.bbox.reshape(2, 2)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from phidl import Device
+import phidl.geometry as pg
+
+# Library of normalized optimal step profiles (Clem & Berggren, PRB 84, 174510), the same curve
+# pg.optimal_step solves for. The curve only depends on the ratio of the two widths, so every profile is
+# stored once for a narrow width of 1 and scaled to the requested widths.
+#   _profiles --> (ratio, width_tol) : (x, y) samples of the exact edge, narrow end first
+#   _steps --> (ratio, width_tol, num_pts, anticrowding_factor, symmetric, exact) : (xpts, ypts, num_squares)
+#
+# By default the outline is the one pg.optimal_step makes for a narrow width of 1, which scales to other
+# widths to within 1e-10 narrow widths. Exact profiles are sampled densely enough that linear
+# interpolation between samples stays within TOLERANCE of the curve, in units of the narrow width.
+TOLERANCE = 1e-6
+_profiles = {}
+_steps = {}
+
+def _step_points(eta, ratio):
+    # Point of the optimal edge from width 1 to width ratio, eta runs from the wide end at 0 to the narrow one at pi
+    a = complex(ratio)
+    gamma = (a*a + 1) / (a*a - 1)
+    w = np.exp(1j * np.asarray(eta))
+    zeta = 4j / np.pi * (np.arctan(np.sqrt((w - gamma) / (gamma + 1))) + a * np.arctan(np.sqrt((gamma - 1) / (w - gamma))))
+    return zeta.real, zeta.imag
+
+def _invert(ratio, y):
+    # Finds eta at the given y by bisection, y decreases monotonically along the edge
+    lo, hi = 0, np.pi
+    for _ in range(52):
+        mid = (lo + hi) / 2
+        above = _step_points(mid, ratio)[1] > y
+        lo, hi = (mid, hi) if above else (lo, mid)
+    return (lo + hi) / 2
+
+def _profile(ratio, width_tol):
+    key = (ratio, width_tol)
+    if key not in _profiles:
+        eta = np.linspace(_invert(ratio, ratio * (1 - width_tol)), _invert(ratio, 1 + width_tol), 257)
+        x, y = _step_points(eta, ratio)
+        # Intervals are split until the curve at their midpoint is within TOLERANCE of the chord
+        split = np.arange(len(eta) - 1)
+        while len(split):
+            em = (eta[split] + eta[split + 1]) / 2
+            xm, ym = _step_points(em, ratio)
+            t = (xm - x[split]) / (x[split + 1] - x[split])
+            bad = np.abs(ym - y[split] - t * (y[split + 1] - y[split])) >= TOLERANCE
+            eta, x, y = [np.insert(v, split + 1, vm) for v, vm in ((eta, em), (x, xm), (y, ym))]
+            split = (split + np.arange(len(split)))[bad]
+            split = np.sort(np.r_[split, split + 1])
+        _profiles[key] = (x[::-1], y[::-1])
+    return _profiles[key]
+
+def _step(ratio, width_tol, num_pts, anticrowding_factor, symmetric, exact):
+    # Outline of the step for a narrow width of 1, with the narrow end on the left
+    key = (ratio, width_tol, num_pts, anticrowding_factor, symmetric, exact)
+    if key not in _steps:
+        if not exact:
+            P = pg.optimal_step(1, ratio, num_pts=num_pts, width_tol=width_tol, anticrowding_factor=anticrowding_factor,
+                                symmetric=symmetric)
+            xpts, ypts = np.array(P.polygons[0].polygons[0]).T
+            _steps[key] = (xpts, ypts, P.info['num_squares'])
+            return _steps[key]
+        x, y = _profile(ratio, width_tol)
+        xpts = np.linspace(x[0], x[-1], num_pts)
+        ypts = np.interp(xpts, x, y)
+        ypts[0], ypts[-1] = 1, ratio
+        num_squares = np.sum(np.diff(xpts) / ((ypts[:-1] + ypts[1:]) / 2))
+        if symmetric:
+            xpts = np.r_[xpts, xpts[::-1]] / 2
+            ypts = np.r_[ypts, -ypts[::-1]] / 2
+        else:
+            xpts = np.r_[xpts, xpts[-1], xpts[0]]
+            ypts = np.r_[ypts, 0, 0]
+        _steps[key] = (xpts * anticrowding_factor, ypts, num_squares)
+    return _steps[key]
+
+# Drop-in replacement for pg.optimal_step that scales a cached normalized profile instead of solving
+# for the curve on every call. Takes the same arguments and returns the same polygon, ports and
+# info['num_squares'], to within 1e-10 times the narrower width.
+#   exact --> use the exact curve instead of the pg.optimal_step one. The fminbound search of phidl stops
+#             short of the curve, by about 1e-2 narrow widths at a ratio of 10 and by tens of narrow widths
+#             at ratios near 100, so exact steps are shorter and differ from pg.optimal_step.
+def optimal_step(start_width=10, end_width=22, num_pts=50, width_tol=1e-3, anticrowding_factor=1.2,
+                 symmetric=False, layer=0, exact=False):
+    D = Device(name='step')
+    if start_width == end_width:
+        xpts = [0, 0, start_width, start_width]
+        ypts = [-start_width/2, start_width/2, start_width/2, -start_width/2] if symmetric else [0, start_width, start_width, 0]
+        D.info['num_squares'] = 1
+    else:
+        narrow, wide = min(start_width, end_width), max(start_width, end_width)
+        ratio = float('%.12g' % (wide / narrow))
+        xpts, ypts, num_squares = _step(ratio, width_tol, num_pts, anticrowding_factor, symmetric, exact)
+        xpts, ypts = xpts * narrow, ypts * narrow
+        if start_width > end_width:
+            xpts = -xpts
+        xpts, ypts = xpts.tolist(), ypts.tolist()
+        D.info['num_squares'] = num_squares
+    D.add_polygon([xpts, ypts], layer=layer)
+
+    if symmetric:
+        D.add_port(name=1, midpoint=[min(xpts), 0], width=start_width, orientation=180)
+        D.add_port(name=2, midpoint=[max(xpts), 0], width=end_width, orientation=0)
+    else:
+        D.add_port(name=1, midpoint=[min(xpts), start_width/2], width=start_width, orientation=180)
+        D.add_port(name=2, midpoint=[max(xpts), end_width/2], width=end_width, orientation=0)
+    return D
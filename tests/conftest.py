@@ -0,0 +1,13 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import importlib.util
+
+# The repository is the package itself, load it as DeviceLib wherever it is checked out
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if 'DeviceLib' not in sys.modules:
+    _spec = importlib.util.spec_from_file_location('DeviceLib', os.path.join(_root, '__init__.py'),
+                                                   submodule_search_locations=[_root])
+    sys.modules['DeviceLib'] = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(sys.modules['DeviceLib'])
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+import pytest
+from phidl import Device
+from DeviceLib.compare import compare
+
+def _device(*boxes, name='D'):
+    D = Device(name)
+    for x0, y0, x1, y1 in boxes:
+        D.add_polygon([(x0, y0), (x1, y0), (x1, y1), (x0, y1)], layer=1)
+    return D
+
+def _area(report):
+    return sum(v['area'] for v in report['layers'].values())
+
+def test_identical_polygons_cancel():
+    report, _ = compare(_device((0, 0, 10, 10), (20, 0, 30, 10)), _device((20, 0, 30, 10), (0, 0, 10, 10)),
+                        workers=1)
+    assert report['identical']
+    assert report['full_tiles'] == 0
+
+def test_same_union_from_overlapping_polygons():
+    A = _device((0, 0, 10, 10), (5, 0, 15, 10))
+    B = _device((0, 0, 10, 10), (10, 0, 15, 10))
+    report, _ = compare(A, B, workers=1)
+    assert report['identical']
+
+def test_covered_duplicate():
+    A = _device((0, 0, 10, 10), (2, 2, 3, 3))
+    B = _device((0, 0, 10, 10), (2, 2, 3, 3), (2, 2, 3, 3))
+    report, _ = compare(A, B, workers=1)
+    assert report['identical']
+
+def test_difference_over_cancelled_polygon():
+    report, _ = compare(_device((0, 0, 10, 10), (5, 0, 15, 10)), _device((0, 0, 10, 10)), workers=1)
+    assert not report['identical']
+    assert _area(report) == pytest.approx(50)
+
+def test_difference_over_shared_cell():
+    C = _device((0, 0, 10, 10), name='C')
+    A, B = _device((5, 0, 15, 10), name='A'), Device('B')
+    A << C
+    B << C
+    report, _ = compare(A, B, workers=1)
+    assert _area(report) == pytest.approx(50)
+
+def test_abutting_difference():
+    report, _ = compare(_device((0, 0, 10, 10), (10, 0, 15, 10)), _device((0, 0, 10, 10)), workers=1)
+    assert _area(report) == pytest.approx(50)
+    assert report['full_tiles'] == 0
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from DeviceLib import nwires
+from DeviceLib.pec import _coverage, _backscatter
+from DeviceLib.polystore import PolygonStore
+
+def test_coverage_is_pixel_area():
+    C = np.zeros((4, 5))
+    _coverage(C, [np.array([[0.5, 0.5], [2.5, 0.5], [2.5, 1.75], [0.5, 1.75]])[::-1]], 0, 0, 1)
+    expected = np.zeros((4, 5))
+    expected[0, :3] = [0.25, 0.5, 0.25]
+    expected[1, :3] = [0.375, 0.75, 0.375]
+    assert np.allclose(C, expected)
+
+def test_coverage_of_thin_lines():
+    # Lines far thinner than a pixel, but longer, keep their area
+    lines = [np.array([[1, 0.5 + k], [9, 0.5 + k], [9, 0.6 + k], [1, 0.6 + k]]) for k in range(5)]
+    C = np.zeros((8, 12))
+    _coverage(C, lines, 0, 0, 1)
+    assert np.isclose(C.sum(), 5 * 8 * 0.1)
+    assert np.allclose(C[:5, 2:8], 0.1)
+
+def test_backscatter_does_not_depend_on_subpixel_position():
+    # Negative-tone meander with 0.1 um trenches at 0.4 um pitch, about half filled, on 2 um pixels
+    W = PolygonStore.from_device(nwires.snspd(width=0.1, pitch=0.4, trench=0.1, size=(40, 40), layer=1))
+    points = np.array([[20, 20], [5, 5], [35, 20], [20, 38]], dtype=float)
+    B = []
+    for dx in np.linspace(0, 1.9, 8):
+        shift = np.array([30 + dx, 30 + 0.6 * dx])
+        B.append(_backscatter([p + shift for p in W], points + shift, 0, 0, 60, 2.0, 5))
+    B = np.array(B)
+    assert np.isclose(B[0, 0], 0.5, atol=0.02)
+    assert np.all(B.max(axis=0) - B.min(axis=0) < 0.01)
@@ -2,6 +2,7 @@
 
 from phidl import Device, CrossSection
 import phidl.geometry as pg
+from .tapers import optimal_step
 import phidl.path as pp
 import phidl.routing as pr
 
@@ -29,7 +30,7 @@ def _branch_start(width=2, size=10, layer=2):
 
 def _choke(width, choke_width, choke_length, layer):
     CD = Device()
-    C = pg.optimal_step(start_width=width, end_width=choke_width, symmetric=True, layer=layer)
+    C = optimal_step(start_width=width, end_width=choke_width, symmetric=True, layer=layer)
     R = pg.compass((choke_length, choke_width), layer=layer)
     choke1 = CD.add_ref(C)
     choke2 = CD.add_ref(C)